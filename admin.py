@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
+from django.db.models import Sum
+from django.utils.translation import ugettext_lazy as _
 
-from .models import Operator, Region, NumberingPlan, NumberingPlanRange
+from .models import Operator, Region, NumberingPlan, NumberingPlanRange, NumberingPlanStats
+from .pagination import EstimatedCountPaginator
 
 
 class OperatorAdmin(admin.ModelAdmin):
@@ -24,9 +27,25 @@ class NumberingPlanAdmin(admin.ModelAdmin):
         'plan_uri',
         'loaded',
         'last_modified',
+        'range_count',
+        'capacity',
     )
     list_filter = ('last_modified', 'loaded')
     search_fields = ('name',)
+
+    def get_queryset(self, request):
+        return super(NumberingPlanAdmin, self).get_queryset(request).annotate(
+            range_count=Sum('stats__range_count'), capacity=Sum('stats__capacity'))
+
+    def range_count(self, obj):
+        return obj.range_count
+    range_count.short_description = _('range count')
+    range_count.admin_order_field = 'range_count'
+
+    def capacity(self, obj):
+        return obj.capacity
+    capacity.short_description = _('capacity')
+    capacity.admin_order_field = 'capacity'
 admin.site.register(NumberingPlan, NumberingPlanAdmin)
 
 
@@ -43,9 +62,45 @@ class NumberingPlanRangeAdmin(admin.ModelAdmin):
     )
     raw_id_fields = ('numbering_plan', 'operator', 'region')
 
-    list_filter = ('numbering_plan__name',)
+    list_filter = ('numbering_plan',)
+    search_fields = ('=prefix',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def get_queryset(self, request):
-        return super(NumberingPlanRangeAdmin, self).get_queryset(request).select_related('region', 'operator')
+        return super(NumberingPlanRangeAdmin, self).get_queryset(request).active().select_related(
+            'numbering_plan', 'region', 'operator')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Phone number search term finds ranges containing the number with `NumberingPlanRange.find`
+        """
+        try:
+            found = NumberingPlanRange.find(search_term.strip())
+        except ValueError:
+            return super(NumberingPlanRangeAdmin, self).get_search_results(request, queryset, search_term)
+        return queryset.filter(pk__in=[r.pk for r in found]), False
 
 admin.site.register(NumberingPlanRange, NumberingPlanRangeAdmin)
+
+
+class NumberingPlanStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        'numbering_plan',
+        'prefix',
+        'operator',
+        'region',
+        'range_count',
+        'capacity',
+    )
+    list_filter = ('numbering_plan__name',)
+    search_fields = ('=prefix', 'operator__name', 'region__name')
+
+    def get_queryset(self, request):
+        return super(NumberingPlanStatsAdmin, self).get_queryset(request).select_related(
+            'numbering_plan', 'operator', 'region')
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(NumberingPlanStats, NumberingPlanStatsAdmin)
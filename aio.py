@@ -0,0 +1,89 @@
+import asyncio
+
+from django.db import close_old_connections
+
+from rfnumplan.index import _index, get_index, LookupResult, FOUND, NOT_FOUND
+from rfnumplan.metrics import timer
+from rfnumplan.normalize import normalize
+
+# batches larger than this are looked up in the executor to keep the event loop responsive
+INLINE_BATCH_SIZE = 1000
+
+_pending = {}
+_refreshing = None
+
+
+def _db_find(number: str) -> list:
+    from rfnumplan.models import NumberingPlanRange
+    close_old_connections()
+    try:
+        with timer('lookup.db'):
+            return list(NumberingPlanRange.find(number))
+    finally:
+        close_old_connections()
+
+
+async def get_async_index():
+    """
+    Returns the process-wide range index without blocking the event loop: the first build runs
+    in the default executor, later version checks are scheduled there in the background.
+    """
+    global _refreshing
+    loop = asyncio.get_event_loop()
+    if _index.instance is None:
+        return await loop.run_in_executor(None, get_index)
+
+    if not _index.is_fresh() and (_refreshing is None or _refreshing.done()):
+        _refreshing = loop.run_in_executor(None, get_index)
+    return _index.instance
+
+
+async def db_find(e164: str) -> list:
+    """
+    Database lookup in the default executor. Concurrent lookups of the same number share one query.
+    """
+    future = _pending.get(e164)
+    if future is None:
+        future = asyncio.ensure_future(asyncio.get_event_loop().run_in_executor(None, _db_find, e164))
+        _pending[e164] = future
+        future.add_done_callback(lambda f: _pending.pop(e164, None))
+    return await asyncio.shield(future)
+
+
+async def afind(phone_number: str) -> list:
+    """
+    Async `NumberingPlanRange.find` served from the in-process index; numbers missing from the index
+    fall back to the database, see `db_find`. Ported numbers are not checked, `afind_many` reports them.
+    :raises ValueError: if number is not valid
+    """
+    e164 = normalize(phone_number)
+    index = await get_async_index()
+    ranges = index.find_number(int(e164))
+    if ranges:
+        return ranges
+    return await db_find(e164)
+
+
+async def afind_many(phone_numbers) -> list:
+    """
+    Async `RangeIndex.find_many`; not found numbers are retried against the database concurrently.
+    :return: list of `LookupResult` in the input order
+    """
+    phone_numbers = list(phone_numbers)
+    index = await get_async_index()
+    if len(phone_numbers) > INLINE_BATCH_SIZE:
+        results = await asyncio.get_event_loop().run_in_executor(None, index.find_many, phone_numbers)
+    else:
+        results = index.find_many(phone_numbers)
+
+    misses = sorted({r.e164 for r in results if r.status == NOT_FOUND})
+    if not misses:
+        return results
+
+    found = dict(zip(misses, await asyncio.gather(*(db_find(e164) for e164 in misses))))
+    return [
+        LookupResult(r.number, r.e164, FOUND if found[r.e164] else NOT_FOUND, found[r.e164], r.source,
+                     found[r.e164][0].operator.name if found[r.e164] else None)
+        if r.status == NOT_FOUND else r
+        for r in results
+    ]
@@ -0,0 +1,97 @@
+import csv
+import json
+from collections import deque
+from multiprocessing import Pool
+
+from rfnumplan.export import init_worker
+from rfnumplan.index import get_index
+from rfnumplan.utils import chunked
+
+FIELDS = ['number', 'e164', 'status', 'plan', 'prefix', 'range_start', 'range_end', 'operator', 'region', 'source']
+
+
+def iter_numbers(lines) -> iter:
+    """
+    Yields the first csv column of every non-empty line
+    """
+    for row in csv.reader(lines):
+        if row and row[0].strip():
+            yield row[0].strip()
+
+
+def lookup_rows(numbers: list) -> list:
+    """
+    Looks up a chunk of numbers with `RangeIndex.find_many`
+    :return: one FIELDS tuple per number; range fields are empty unless the number was found,
+             operator is the current one for ported numbers
+    """
+    res = []
+    for r in get_index().find_many(numbers):
+        if r.ranges:
+            nr = r.ranges[0]
+            res.append((r.number, r.e164, r.status, nr.numbering_plan.name, nr.prefix, str(nr.range_start)[1:],
+                        str(nr.range_end)[1:], r.operator, nr.region.name, r.source))
+        else:
+            res.append((r.number, r.e164 or '', r.status, '', '', '', '', r.operator or '', '', r.source or ''))
+    return res
+
+
+def write_rows(f, rows: list, fmt='csv'):
+    if fmt == 'jsonl':
+        for row in rows:
+            f.write(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False))
+            f.write('\n')
+    else:
+        csv.writer(f).writerows(rows)
+
+
+def imap_bounded(pool, func, chunks, limit: int) -> iter:
+    """
+    Ordered `pool.imap` that keeps at most `limit` chunks in flight, so `chunks` are read
+    only as fast as the results are consumed
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(func, (chunk,)))
+        if len(pending) >= limit:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def bulk_lookup(lines, output, fmt='csv', jobs=1, chunk_size=10000, progress=None) -> dict:
+    """
+    Streams numbers from `lines` into `output` in chunks of `chunk_size`, looked up by `jobs` processes.
+    The index is built before the pool is forked, so workers share it copy-on-write.
+    At most 2 * `jobs` chunks are in flight, memory does not grow with the input size.
+    :param progress: optional callable receiving running totals after every chunk
+    :return: totals by status plus `total`
+    """
+    totals = {'total': 0}
+    if fmt == 'csv':
+        csv.writer(output).writerow(FIELDS)
+
+    get_index()
+    chunks = chunked(iter_numbers(lines), chunk_size)
+    pool = None
+    if jobs > 1:
+        from django.db import connections
+        connections.close_all()
+        pool = Pool(jobs, initializer=init_worker)
+        results = imap_bounded(pool, lookup_rows, chunks, 2 * jobs)
+    else:
+        results = map(lookup_rows, chunks)
+
+    try:
+        for rows in results:
+            write_rows(output, rows, fmt)
+            totals['total'] += len(rows)
+            for row in rows:
+                totals[row[2]] = totals.get(row[2], 0) + 1
+            if progress:
+                progress(totals)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return totals
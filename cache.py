@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.db.models import F
+
+from .metrics import timer, incr
+from .settings import LOOKUP_CACHE_SIZE, LOOKUP_CACHE_BLOCK_SIZE, LOOKUP_CACHE_CHECK_INTERVAL, MAX_RANGE_CAPACITY
+
+# monotonic time of the last bump made by this process
+_bumped_at = 0
+
+
+def get_data_version() -> int:
+    """
+    Plans data version shared by all processes through the `DataVersion` row: every process sees a bump
+    as soon as the change is committed
+    """
+    from rfnumplan.models import DataVersion
+    return DataVersion.objects.filter(pk=DataVersion.ROW).values_list('version', flat=True).first() or 0
+
+
+def bump_data_version() -> int:
+    """
+    Invalidates every cache keyed on data version; called whenever stored ranges change
+    """
+    from rfnumplan.models import DataVersion
+    global _bumped_at
+    _bumped_at = time.monotonic()
+    if not DataVersion.objects.filter(pk=DataVersion.ROW).update(version=F('version') + 1):
+        DataVersion.objects.get_or_create(pk=DataVersion.ROW, defaults={'version': 1})
+    return get_data_version()
+
+
+def is_version_fresh(checked_at: float, interval: float) -> bool:
+    """
+    True if data version read at `checked_at` may be reused without a query: it was read less than `interval`
+    seconds ago and this process has not bumped it since, so own changes are seen at once
+    """
+    return checked_at > _bumped_at and time.monotonic() - checked_at < interval
+
+
+class LookupCache(object):
+    """
+    Bounded LRU cache of normalized number -> list of ranges, keyed on plans data version.
+    If a single range covers the whole `block_size` block around a number, the block is cached instead,
+    so one miss serves every number of that block.
+    """
+
+    def __init__(self, maxsize=LOOKUP_CACHE_SIZE, block_size=LOOKUP_CACHE_BLOCK_SIZE,
+                 check_interval=LOOKUP_CACHE_CHECK_INTERVAL):
+        self.maxsize = maxsize
+        self.block_size = block_size
+        self.check_interval = check_interval
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = 0
+        self.hits = self.block_hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'block_hits': self.block_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def check_version(self):
+        if self.version is not None and is_version_fresh(self.checked_at, self.check_interval):
+            return
+        now = time.monotonic()
+        version = get_data_version()
+        with self.lock:
+            if version != self.version:
+                self.data.clear()
+                self.version = version
+            self.checked_at = now
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def find(self, phone_number: str) -> list:
+        """
+        Cached `NumberingPlanRange.find`
+        :return: list of ranges
+        """
+        from rfnumplan.models import NumberingPlanRange
+
+        self.check_version()
+        number = int(NumberingPlanRange.normalize(phone_number))
+
+        ranges = self.get(number)
+        if ranges is not None:
+            self.hits += 1
+            incr('lookup.cache.hit')
+            return list(ranges)
+
+        block = None
+        if self.block_size:
+            block = ('block', number // self.block_size)
+            ranges = self.get(block)
+            if ranges is not None:
+                self.block_hits += 1
+                incr('lookup.cache.block_hit')
+                return list(ranges)
+
+        self.misses += 1
+        incr('lookup.cache.miss')
+        with timer('lookup.db'):
+            ranges = tuple(NumberingPlanRange.find(phone_number))
+        if block and self.spans_block(ranges, block[1]):
+            # the block is checked on the second miss in it, so scattered lookups cost a single query each
+            seen = ('seen', block[1])
+            if self.get(seen) and self.covers_block(block[1]):
+                self.put(block, ranges)
+                return list(ranges)
+            self.put(seen, True)
+        self.put(number, ranges)
+        return list(ranges)
+
+    def spans_block(self, ranges: tuple, block: int) -> bool:
+        """
+        True if a single range is found and it spans the whole block
+        """
+        start, end = block * self.block_size, (block + 1) * self.block_size - 1
+        return len(ranges) == 1 and ranges[0].number_start <= start <= end <= ranges[0].number_end
+
+    def covers_block(self, block: int) -> bool:
+        """
+        True if the range that `spans_block` is the only one intersecting the block
+        """
+        from rfnumplan.models import NumberingPlanRange
+
+        start, end = block * self.block_size, (block + 1) * self.block_size - 1
+        return len(NumberingPlanRange.objects.active().filter(
+            number_start__lte=end, number_start__gt=start - MAX_RANGE_CAPACITY, number_end__gte=start,
+        ).values_list('pk', flat=True)[:2]) == 1
+
+
+lookup_cache = LookupCache()
+
+
+def cached_find(phone_number: str) -> list:
+    """
+    `NumberingPlanRange.find` through the process-wide `LookupCache`; ported numbers are not checked
+    """
+    return lookup_cache.find(phone_number)
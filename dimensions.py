@@ -0,0 +1,91 @@
+import re
+import threading
+import time
+
+from django.apps import apps
+
+from .cache import get_data_version, is_version_fresh
+from .settings import LOOKUP_CACHE_CHECK_INTERVAL
+
+SPACES = re.compile(r'\s+')
+
+
+def name_key(name: str) -> str:
+    """
+    Search key of operator or region name: casefolded, `ё` -> `е`, single spaces. Quotes and other characters
+    are kept, so a term matches the same names as a case-insensitive substring search of the raw names.
+    name_key('ООО  "Т2 Мобайл"') -> 'ооо "т2 мобайл"'
+    """
+    return SPACES.sub(' ', name.casefold().replace('ё', 'е'))
+
+
+class DimensionCache(object):
+    """
+    Process-wide map of Operator or Region names to instances, reloaded with a single query when
+    plans data version changes (see `rfnumplan.cache.get_data_version`).
+    Imports resolve names through it, so known names cost no queries.
+    """
+
+    def __init__(self, model_name: str, check_interval=LOOKUP_CACHE_CHECK_INTERVAL):
+        self.model_name = model_name
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.by_name = {}
+        self.keys = []
+        self.version = None
+        self.checked_at = 0
+
+    @property
+    def model(self):
+        return apps.get_model('rfnumplan', self.model_name)
+
+    def check_version(self):
+        if self.version is not None and is_version_fresh(self.checked_at, self.check_interval):
+            return
+        now = time.monotonic()
+        version = get_data_version()
+        with self.lock:
+            if version != self.version:
+                self.by_name, self.keys = {}, []
+                self.add(self.model.objects.all())
+                self.version = version
+            self.checked_at = now
+
+    def add(self, instances):
+        for instance in instances:
+            self.by_name[instance.name] = instance
+            self.keys.append((name_key(instance.name), instance.pk))
+
+    def get_or_create(self, names) -> dict:
+        """
+        Same as `rfnumplan.utils.map_instances_by_name`, but queries only names this process has not seen yet
+        :return: instances by name
+        """
+        self.check_version()
+        with self.lock:
+            missing = set(names) - self.by_name.keys()
+            if missing:
+                model = self.model
+                self.add(model.objects.filter(name__in=missing))
+                created = missing - self.by_name.keys()
+                if created:
+                    model.objects.bulk_create(model(name=name) for name in created)
+                    self.add(model.objects.filter(name__in=created))
+            return {name: self.by_name[name] for name in names}
+
+    def search(self, terms) -> set:
+        """
+        :param terms: name parts, matched as case-insensitive substrings of `name_key`
+        :return: ids of instances matching any of `terms`
+        """
+        self.check_version()
+        terms = [name_key(term) for term in terms]
+        return {pk for key, pk in self.keys if any(term in key for term in terms)}
+
+    def clear(self):
+        with self.lock:
+            self.by_name, self.keys, self.version = {}, [], None
+
+
+operator_cache = DimensionCache('Operator')
+region_cache = DimensionCache('Region')
@@ -0,0 +1,145 @@
+import csv
+import gzip
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from itertools import groupby
+from multiprocessing import Pool
+from operator import itemgetter
+
+from rfnumplan.utils import range_to_prefix, coalesce_ranges, collapse_prefixes
+
+BUFFER_SIZE = 1024 * 1024
+
+FORMATS = ('csv', 'jsonl')
+
+
+def iter_prefix_rows(ranges, coalesce=False, collapse=False) -> iter:
+    """
+    Yields (prefix, operator name, region name) tuples for ranges queryset.
+    Ranges are streamed as plain tuples, model instances are never created. Rows follow ranges order
+    (plan, prefix, range start) unless they are coalesced or collapsed, which groups them by operator and region
+    within every (plan, prefix), so the output does not depend on how the export is sharded.
+    :param coalesce: merge contiguous ranges of the same plan, prefix, operator and region before computing prefixes
+    :param collapse: replace complete sets of ten sibling prefixes with their parent
+    """
+    fields = ['numbering_plan_id', 'prefix', 'operator__name', 'region__name', 'number_start', 'number_end']
+    if coalesce or collapse:
+        ordering = ['numbering_plan_id', 'prefix', 'operator__name', 'region__name', 'number_start']
+    else:
+        ordering = ['numbering_plan_id', 'prefix', 'range_start']
+    rows = ranges.order_by(*ordering).values_list(*fields)
+    items = (((plan_id, prefix, operator, region), start, end)
+             for plan_id, prefix, operator, region, start, end in rows.iterator())
+    if coalesce:
+        items = coalesce_ranges(items)
+
+    for (_plan_id, _prefix, operator, region), group in groupby(items, key=itemgetter(0)):
+        prefixes = (prefix for _key, start, end in group for prefix in range_to_prefix(start, end))
+        if collapse:
+            prefixes = collapse_prefixes(prefixes)
+        for prefix in prefixes:
+            yield str(prefix), operator, region
+
+
+def open_output(path: str, mode='w'):
+    """
+    Opens buffered text output, gzip-compressed if `path` ends with `.gz`
+    """
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedWriter(gzip.open(path, mode + 'b'), BUFFER_SIZE),
+                                encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='', buffering=BUFFER_SIZE)
+
+
+def write_rows(f, rows, field_names: list, fmt='csv', extra=()) -> int:
+    """
+    Writes (prefix, operator, region) rows with `extra` values appended to each of them
+    :return: number of rows written
+    """
+    count = 0
+    if fmt == 'jsonl':
+        for row in rows:
+            f.write(json.dumps(dict(zip(field_names, row + extra)), ensure_ascii=False))
+            f.write('\n')
+            count += 1
+        return count
+
+    writer = csv.writer(f)
+    for row in rows:
+        writer.writerow(row + extra)
+        count += 1
+    return count
+
+
+# ranges queryset of a pool worker, see `init_worker`
+_ranges = None
+
+
+def export_shard(args) -> tuple:
+    """
+    Pool worker: writes prefixes of a single (plan, prefix) shard into a temporary file
+    :return: (temporary file path, rows count)
+    """
+    plan_id, prefix, field_names, fmt, extra, coalesce, collapse = args
+    ranges = _ranges.filter(numbering_plan_id=plan_id, prefix=prefix)
+    fd, path = tempfile.mkstemp(prefix='rfnumplan-', suffix='.' + fmt)
+    with os.fdopen(fd, 'w', encoding='utf-8', newline='', buffering=BUFFER_SIZE) as f:
+        count = write_rows(f, iter_prefix_rows(ranges, coalesce, collapse), field_names, fmt, extra)
+    return path, count
+
+
+def init_worker(query: bytes = None):
+    """
+    Pool initializer: sets django up in the worker
+    :param query: pickled `Query` of the exported ranges; a pickled QuerySet would be evaluated by the parent
+    """
+    global _ranges
+    import django
+    django.setup()
+    if query is not None:
+        query = pickle.loads(query)
+        _ranges = query.model._default_manager.all()
+        _ranges.query = query
+
+
+def write_prefixes(ranges, path: str, fmt='csv', extra_fields: dict = None, coalesce=False, collapse=False,
+                   jobs=1, progress=None) -> int:
+    """
+    Exports prefixes of ranges queryset into `path` as csv or jsonl (gzipped if `path` ends with `.gz`).
+    With `jobs` > 1 ranges are sharded by (plan, prefix) and exported by a process pool; shards are
+    concatenated in order, so the output is the same as with a single job.
+    :param extra_fields: constant columns appended to every row, e.g. {'cost': 1.5}
+    :param progress: optional wrapper for the rows iterator, e.g. tqdm
+    :return: number of rows written
+    """
+    extra_fields = extra_fields or {}
+    field_names = ['prefix', 'operator', 'region', *extra_fields.keys()]
+    extra = tuple(extra_fields.values())
+
+    with open_output(path) as f:
+        if fmt == 'csv':
+            csv.writer(f).writerow(field_names)
+
+        if jobs <= 1:
+            rows = iter_prefix_rows(ranges, coalesce, collapse)
+            return write_rows(f, progress(rows) if progress else rows, field_names, fmt, extra)
+
+        from django.db import connections
+        shards = ranges.order_by('numbering_plan_id', 'prefix').values_list('numbering_plan_id', 'prefix').distinct()
+        tasks = [(plan_id, prefix, field_names, fmt, extra, coalesce, collapse) for plan_id, prefix in shards]
+        query = pickle.dumps(ranges.query)
+        # forked workers must not share parent's database connections
+        connections.close_all()
+
+        count = 0
+        with Pool(jobs, initializer=init_worker, initargs=(query,)) as pool:
+            for shard_path, shard_count in pool.imap(export_shard, tasks):
+                with open(shard_path, 'r', encoding='utf-8', newline='') as shard:
+                    shutil.copyfileobj(shard, f, BUFFER_SIZE)
+                os.remove(shard_path)
+                count += shard_count
+        return count
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+from contextlib import closing
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import dateutil.parser
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import timer, incr, observe
+from .settings import CACHE_DIR, FETCH_TIMEOUT
+
+CHUNK_SIZE = 64 * 1024
+
+FetchResult = namedtuple('FetchResult', ['path', 'etag', 'last_modified', 'content_hash', 'modified'])
+
+_session = None
+
+
+def get_session() -> requests.Session:
+    """
+    Process-wide connection-pooled session
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=2)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+    return _session
+
+
+def file_hash(path: str, digest=None) -> str:
+    digest = digest or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PlanFetcher(object):
+    """
+    Downloads plan files into an on-disk cache keyed by uri.
+    Every cached file has a json sidecar with its ETag, Last-Modified and sha256, which are used for
+    a single conditional GET next time. Interrupted downloads are resumed with a Range request.
+    `file://` uris are read in place.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, session: requests.Session = None, timeout=FETCH_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.session = session or get_session()
+        self.timeout = timeout
+
+    def get_paths(self, uri: str) -> tuple:
+        """
+        :return: (data path, partial download path, metadata path) for `uri`
+        """
+        key = hashlib.sha1(uri.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.csv', base + '.part', base + '.json'
+
+    def read_meta(self, uri: str) -> dict:
+        path, _part_path, meta_path = self.get_paths(uri)
+        if not (os.path.exists(path) and os.path.exists(meta_path)):
+            return {}
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        return meta if meta.get('uri') == uri else {}
+
+    def write_meta(self, uri: str, meta: dict):
+        _path, _part_path, meta_path = self.get_paths(uri)
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(meta, uri=uri), f)
+        os.replace(tmp_path, meta_path)
+
+    def fetch(self, uri: str, force=False) -> FetchResult:
+        """
+        :param force: ignore cached validators and download the file again
+        :return: `FetchResult`; `modified` is False if the cached copy was reused
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme == 'file':
+            return self.fetch_file(url2pathname(parsed.path))
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path, part_path, _meta_path = self.get_paths(uri)
+        meta = {} if force else self.read_meta(uri)
+
+        headers = {'Accept-Encoding': 'identity'}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        part_meta = self.read_part_meta(uri)
+        offset = os.path.getsize(part_path) if part_meta and os.path.exists(part_path) else 0
+        if offset and part_meta.get('etag'):
+            headers['Range'] = 'bytes=%s-' % offset
+            headers['If-Range'] = part_meta['etag']
+
+        with timer('fetch.request'):
+            response = self.session.get(uri, headers=headers, stream=True, timeout=self.timeout)
+        with closing(response):
+            if response.status_code == 304:
+                incr('fetch.not_modified')
+                return self.make_result(path, meta, modified=False)
+            response.raise_for_status()
+
+            etag, last_modified = response.headers.get('ETag', ''), response.headers.get('Last-Modified', '')
+            self.write_part_meta(uri, {'etag': etag})
+
+            digest = hashlib.sha256()
+            if response.status_code == 206:
+                file_hash(part_path, digest)
+                mode = 'ab'
+            else:
+                mode = 'wb'
+
+            with timer('fetch.download'), open(part_path, mode) as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+            observe('fetch.bytes', os.path.getsize(part_path))
+
+        os.replace(part_path, path)
+        os.remove(self.get_part_meta_path(uri))
+        meta = {'etag': etag, 'last_modified': last_modified, 'content_hash': digest.hexdigest()}
+        self.write_meta(uri, meta)
+        return self.make_result(path, meta, modified=True)
+
+    @staticmethod
+    def fetch_file(path: str) -> FetchResult:
+        mtime = datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+        return FetchResult(path=path, etag='', last_modified=mtime, content_hash=file_hash(path), modified=True)
+
+    @staticmethod
+    def make_result(path: str, meta: dict, modified: bool) -> FetchResult:
+        last_modified = meta.get('last_modified')
+        return FetchResult(
+            path=path,
+            etag=meta.get('etag', ''),
+            last_modified=dateutil.parser.parse(last_modified) if last_modified else None,
+            content_hash=meta.get('content_hash', ''),
+            modified=modified,
+        )
+
+    def get_part_meta_path(self, uri: str) -> str:
+        return self.get_paths(uri)[1] + '.json'
+
+    def read_part_meta(self, uri: str) -> dict:
+        part_meta_path = self.get_part_meta_path(uri)
+        if not os.path.exists(part_meta_path):
+            return {}
+        with open(part_meta_path, 'r') as f:
+            return json.load(f)
+
+    def write_part_meta(self, uri: str, meta: dict):
+        with open(self.get_part_meta_path(uri), 'w') as f:
+            json.dump(meta, f)
@@ -0,0 +1,264 @@
+import bisect
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+from django.db import models
+
+from .metrics import timer, observe
+from .normalize import normalize_many
+from .portability import get_overlay
+from .settings import INDEX_CHECK_INTERVAL
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+FOUND = 'found'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+
+# which source answered: numbering plan ranges or mobile number portability overlay
+RANGES = 'ranges'
+PORTED = 'ported'
+
+LookupResult = namedtuple('LookupResult', ['number', 'e164', 'status', 'ranges', 'source', 'operator'])
+LookupResult.__new__.__defaults__ = (RANGES, None)
+
+
+class RangeIndex(object):
+    """
+    Immutable in-process index of all numbering plan ranges.
+    Ranges are kept in array-backed columns sorted by absolute range start, so a lookup
+    is a bisect over `starts` and never touches the database.
+    """
+
+    def __init__(self, rows, plans: dict, operators: dict, regions: dict, version=None):
+        """
+        :param rows: iterable of (start, end, id, plan_id, prefix, range_start, range_end, range_capacity,
+                     operator_id, region_id) tuples
+        """
+        self.version = version
+        self.plans = plans
+        self.operators = operators
+        self.regions = regions
+
+        self.starts, self.ends, self.max_ends = array('q'), array('q'), array('q')
+        self.ids, self.plan_ids, self.prefixes = array('q'), array('l'), array('l')
+        self.range_starts, self.range_ends, self.capacities = array('q'), array('q'), array('q')
+        self.operator_ids, self.region_ids = array('l'), array('l')
+
+        max_end = -1
+        for row in sorted(rows):
+            start, end, pk, plan_id, prefix, range_start, range_end, capacity, operator_id, region_id = row
+            max_end = max(max_end, end)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.max_ends.append(max_end)
+            self.ids.append(pk)
+            self.plan_ids.append(plan_id)
+            self.prefixes.append(prefix)
+            self.range_starts.append(range_start)
+            self.range_ends.append(range_end)
+            self.capacities.append(capacity)
+            self.operator_ids.append(operator_id)
+            self.region_ids.append(region_id)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @staticmethod
+    def current_version():
+        """
+        Cheap signature of the stored plans: it changes whenever a plan is reloaded or cleared.
+        """
+        from rfnumplan.cache import get_data_version
+        from rfnumplan.models import NumberingPlan, NumberingPlanRange
+        plans = tuple(NumberingPlan.objects.order_by('pk').values_list(
+            'pk', 'prefix', 'loaded', 'last_modified', 'active_generation'
+        ))
+        stats = NumberingPlanRange.objects.active().order_by().aggregate(
+            count=models.Count('pk'), max_id=models.Max('pk')
+        )
+        return get_data_version(), plans, stats['count'], stats['max_id']
+
+    @classmethod
+    def build(cls, version=None):
+        from rfnumplan.models import NumberingPlan, NumberingPlanRange, Operator, Region
+        if version is None:
+            version = cls.current_version()
+
+        fields = ['number_start', 'number_end', 'pk', 'numbering_plan_id', 'prefix', 'range_start', 'range_end',
+                  'range_capacity', 'operator_id', 'region_id']
+        rows = NumberingPlanRange.objects.active().order_by().values_list(*fields).iterator()
+        with timer('index.build'):
+            return cls(rows, NumberingPlan.objects.in_bulk(), Operator.objects.in_bulk(), Region.objects.in_bulk(),
+                       version=version)
+
+    def positions(self, number: int) -> list:
+        """
+        Returns positions of all ranges containing `number`.
+        `max_ends` is a running maximum of range ends, so the backward walk stops
+        as soon as no earlier range can reach `number`.
+        """
+        res = []
+        i = bisect.bisect_right(self.starts, number) - 1
+        while i >= 0 and self.max_ends[i] >= number:
+            if self.ends[i] >= number:
+                res.append(i)
+            i -= 1
+        return res
+
+    def positions_many(self, numbers: list) -> list:
+        """
+        Vectorized `positions`: one `numpy.searchsorted` over range starts for the whole batch.
+        Only numbers that may fall into overlapping ranges are walked one by one.
+        """
+        if np is None or not len(self):
+            return [self.positions(number) for number in numbers]
+
+        starts = np.frombuffer(self.starts, dtype=np.int64)
+        ends = np.frombuffer(self.ends, dtype=np.int64)
+        max_ends = np.frombuffer(self.max_ends, dtype=np.int64)
+
+        ns = np.asarray(numbers, dtype=np.int64)
+        idx = np.searchsorted(starts, ns, side='right') - 1
+        valid = idx >= 0
+        safe = np.where(valid, idx, 0)
+        hit = valid & (ends[safe] >= ns)
+        prev_max_ends = np.where(safe > 0, max_ends[np.maximum(safe - 1, 0)], -1)
+        overlapped = valid & (prev_max_ends >= ns)
+
+        res = [[i] if h else [] for i, h in zip(idx.tolist(), hit.tolist())]
+        for j in np.flatnonzero(overlapped).tolist():
+            res[j] = self.positions(numbers[j])
+        return res
+
+    def get_range(self, i: int):
+        from rfnumplan.models import NumberingPlanRange
+        return NumberingPlanRange(
+            pk=self.ids[i],
+            numbering_plan=self.plans[self.plan_ids[i]],
+            prefix=self.prefixes[i],
+            range_start=self.range_starts[i],
+            range_end=self.range_ends[i],
+            range_capacity=self.capacities[i],
+            operator=self.operators[self.operator_ids[i]],
+            region=self.regions[self.region_ids[i]],
+        )
+
+    def find_number(self, number: int) -> list:
+        with timer('lookup.index'):
+            ranges = [self.get_range(i) for i in self.positions(number)]
+            return sorted(ranges, key=lambda nr: (nr.numbering_plan_id, nr.prefix, nr.range_start))
+
+    def find(self, phone_number: str) -> list:
+        """
+        Same as `NumberingPlanRange.find`, but answered from memory; ported numbers are not checked either.
+        :return: list of unsaved-looking `NumberingPlanRange` instances with plan, operator and region attached
+        """
+        from rfnumplan.models import NumberingPlanRange
+        return self.find_number(int(NumberingPlanRange.normalize(phone_number)))
+
+    def find_many(self, phone_numbers) -> list:
+        """
+        Batch lookup. Every number is normalized once per batch and all of them are searched at once.
+        Ported numbers are answered from the portability overlay (see `rfnumplan.portability`), if there is one.
+        :return: list of `LookupResult` in the input order; `status` is one of FOUND, NOT_FOUND, INVALID,
+                 `source` is RANGES or PORTED (None for INVALID numbers, which are not looked up),
+                 `operator` is the name of the operator serving the number
+        """
+        phone_numbers = list(phone_numbers)
+        observe('lookup.batch.size', len(phone_numbers))
+        with timer('lookup.batch'):
+            return self._find_many(phone_numbers)
+
+    def _find_many(self, phone_numbers: list) -> list:
+        normalized = normalize_many(phone_numbers)
+
+        unique = sorted({int(e164) for e164 in normalized if e164})
+        found = dict(zip(unique, self.positions_many(unique)))
+        overlay = get_overlay()
+        ported = dict(zip(unique, overlay.lookup_many(unique))) if overlay else {}
+
+        ranges_cache = {}
+
+        def get_ranges(positions):
+            for i in positions:
+                if i not in ranges_cache:
+                    ranges_cache[i] = self.get_range(i)
+            return sorted((ranges_cache[i] for i in positions),
+                          key=lambda nr: (nr.numbering_plan_id, nr.prefix, nr.range_start))
+
+        res = []
+        for phone_number, e164 in zip(phone_numbers, normalized):
+            if not e164:
+                res.append(LookupResult(phone_number, None, INVALID, [], None))
+                continue
+            positions = found[int(e164)]
+            ranges = get_ranges(positions)
+            operator = ported.get(int(e164))
+            if operator:
+                res.append(LookupResult(phone_number, e164, FOUND, ranges, PORTED, operator))
+            else:
+                res.append(LookupResult(phone_number, e164, FOUND if positions else NOT_FOUND, ranges, RANGES,
+                                        ranges[0].operator.name if ranges else None))
+        return res
+
+
+class VersionedInstance(object):
+    """
+    Process-wide lazily built object that is rebuilt when stored plans version changes.
+    Version is checked at most once per `RFNUMPLAN_INDEX_CHECK_INTERVAL` seconds.
+    """
+
+    def __init__(self, build):
+        """
+        :param build: callable accepting `version` keyword and returning an object with `version` attribute
+        """
+        self.build = build
+        self.instance = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def get(self, check_version=True):
+        instance = self.instance
+        if instance is not None and (not check_version or time.monotonic() - self.checked_at < INDEX_CHECK_INTERVAL):
+            return instance
+
+        with self.lock:
+            if self.instance is not None and time.monotonic() - self.checked_at < INDEX_CHECK_INTERVAL:
+                return self.instance
+
+            version = RangeIndex.current_version()
+            if self.instance is None or self.instance.version != version:
+                self.instance = self.build(version=version)
+            self.checked_at = time.monotonic()
+            return self.instance
+
+    def is_fresh(self) -> bool:
+        """
+        True if the instance is built and does not need a version check yet
+        """
+        return self.instance is not None and time.monotonic() - self.checked_at < INDEX_CHECK_INTERVAL
+
+    def reset(self):
+        with self.lock:
+            self.instance, self.checked_at = None, 0
+
+
+_index = VersionedInstance(RangeIndex.build)
+
+
+def get_index(check_version=True) -> RangeIndex:
+    """
+    Returns process-wide `RangeIndex`, see `VersionedInstance`
+    """
+    return _index.get(check_version=check_version)
+
+
+def reset_index():
+    _index.reset()
@@ -1,19 +1,27 @@
+import cProfile
 import sys
-import phonenumbers
-import csv
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from django.template.defaultfilters import truncatechars
 from terminaltables import SingleTable
 
-from django.core.paginator import Paginator
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Sum
 from django.utils.translation import activate
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import termcolors
 from django.core.management import color
 
+from rfnumplan.cache import bump_data_version
+from rfnumplan.export import write_prefixes, open_output, FORMATS
+from rfnumplan.index import FOUND, NOT_FOUND, INVALID
+from rfnumplan.metrics import collect, timer, TIMER
+from rfnumplan.portability import get_overlay
+from rfnumplan.settings import SNAPSHOT_PATH, BULK_CHUNK_SIZE, PORTABILITY_PATH, PAGE_SIZE, LIST_CHUNK_SIZE
+
 
 try:
     from tqdm import tqdm
@@ -71,6 +79,8 @@ class Command(BaseCommand):
                             help=str(_('Show page with PAGE number')))
         parser.add_argument('--page-size', '-s', default=20, dest='page_size',
                             help=str(_('Set page size for tables')))
+        parser.add_argument('--after', type=str, metavar='KEY',
+                            help=str(_('Show ranges after KEY printed with the previous page')))
         parser.add_argument('--operator', '-o', dest='operator', action='append', default=[],
                             help=str(_('Filter --plan with operator name(s)')))
         parser.add_argument('--region', '-r', dest='region', action='append', default=[],
@@ -87,6 +97,12 @@ class Command(BaseCommand):
                             help=str(_('Converts ranges into prefixes')))
         parser.add_argument('--csv', type=str,
                             help=str(_('Output --prefixes and save it to csv if filepath specified')))
+        parser.add_argument('--format', choices=FORMATS, default='csv',
+                            help=str(_('Output format of --csv and --output files, gzipped if name ends with .gz')))
+        parser.add_argument('--coalesce', action='store_true', default=False,
+                            help=str(_('Merge adjacent ranges of the same operator and region in --csv output')))
+        parser.add_argument('--collapse', action='store_true', default=False,
+                            help=str(_('Replace ten sibling prefixes with their parent in --csv output')))
         parser.add_argument('--cost', type=float,
                             help=str(_('Add cost into csv output')))
         parser.add_argument('--price', type=float,
@@ -95,42 +111,69 @@ class Command(BaseCommand):
                             help=str(_('Fetch numbering plan\'s data from urls')))
         parser.add_argument('--force', action='store_true', default=False,
                             help=str(_('Force numbering plans update')))
+        parser.add_argument('--incremental', action='store_true', default=False,
+                            help=str(_('Update only changed ranges instead of reloading numbering plans')))
+        parser.add_argument('--jobs', '-j', type=int, default=1, dest='jobs',
+                            help=str(_('Number of parallel jobs')))
+        parser.add_argument('--snapshot', type=str,
+                            help=str(_('Write binary ranges snapshot to SNAPSHOT path (after --update if given)')))
         parser.add_argument('--clear', action='store_true', default=False,
                             help=str(_('Clear all numbering plans content')))
+        parser.add_argument('--create-range-index', action='store_true', default=False,
+                            help=str(_('Create and fill database-native range index table')))
         parser.add_argument('--range-summary', action='store_true', default=False,
                             help=str(_('Show plan range prefixes summary')))
+        parser.add_argument('--input', '-i', type=str,
+                            help=str(_('Look up numbers from INPUT file (one per line or first csv column), - for stdin')))
+        parser.add_argument('--output', type=str,
+                            help=str(_('Write --input lookup results to OUTPUT file instead of stdout')))
+        parser.add_argument('--portability', type=str, metavar='FILE',
+                            help=str(_('Replace ported numbers overlay with registry FILE')))
+        parser.add_argument('--portability-delta', type=str, action='append', default=[], metavar='FILE',
+                            help=str(_('Apply daily ported numbers delta FILE(s) to the overlay')))
+        parser.add_argument('--profile', nargs='?', const='', metavar='PATH',
+                            help=str(_('Print time spent in import and lookup phases; with PATH also write '
+                                       'cProfile stats into it')))
         parser.add_argument('phones', nargs='*', default=[], type=str,
                             help=str(_('Phones to check')))
 
     @staticmethod
     def get_phone_info(num) -> dict:
+        """
+        Number is considered valid if it normalizes and belongs to some loaded numbering plan range
+        """
         from rfnumplan.models import NumberingPlanRange
-        n = phonenumbers.parse(num, region='RU')
+        try:
+            e164 = NumberingPlanRange.normalize(num)
+        except ValueError:
+            e164 = None
+
         res = {
             'num': num,
-            'e164': phonenumbers.format_number(n, phonenumbers.PhoneNumberFormat.E164),
-            'possible': phonenumbers.is_possible_number(n),
-            'valid': phonenumbers.is_valid_number(n),
-            'info': []
+            'e164': '+%s' % e164 if e164 else num,
+            'possible': e164 is not None,
+            'valid': False,
+            'info': [],
+            'ported': None,
         }
 
-        if res['valid']:
-            res['info'] = NumberingPlanRange.find(res['e164'])
+        if e164:
+            with timer('lookup.db'):
+                res['info'] = list(NumberingPlanRange.find(e164))
+            overlay = get_overlay()
+            res['ported'] = overlay.lookup(int(e164)) if overlay else None
+            res['valid'] = bool(res['info'] or res['ported'])
 
         return res
 
-    def paginated(self, queryset, options):
-        page_num = int(options.get('page'))
-        if page_num:
-            per_page = options.get('page_size', 0) or settings.PAGE_SIZE
-        else:
-            page_num = 1
-            per_page = sys.maxsize
-
-        p = Paginator(queryset, per_page)
-        page = p.page(page_num)
-
-        return page
+    def count_plan_ranges(self, options) -> int:
+        """
+        Exact number of ranges `handle_list_plan_ranges` lists, summed from `NumberingPlanStats`
+        """
+        from rfnumplan.models import NumberingPlanStats
+        stats = NumberingPlanStats.objects.filter(numbering_plan__in=self.get_plans_qs(options))
+        stats = self.filter_plan_ranges_queryset(stats, options)
+        return stats.aggregate(count=Sum('range_count'))['count'] or 0
 
     def handle_list_plans(self):
         from rfnumplan.models import NumberingPlan
@@ -150,121 +193,185 @@ class Command(BaseCommand):
 
     def get_plan_ranges_queryset(self, options):
         from rfnumplan.models import NumberingPlanRange
-        return NumberingPlanRange.objects.filter(numbering_plan__in=self.get_plans_qs(options))
+        return NumberingPlanRange.objects.active().filter(numbering_plan__in=self.get_plans_qs(options))
 
     def filter_plan_ranges_queryset(self, ranges, options):
+        """
+        Name filters are matched against cached operator and region names (see `rfnumplan.dimensions`),
+        so the ranges query gets indexed `operator_id IN (...)` / `region_id IN (...)` conditions instead of joins
+        """
+        from rfnumplan.dimensions import operator_cache, region_cache
         operators, regions, exclude_operators, exclude_regions = \
             options.get('operator'), options.get('region'), \
             options.get('exclude_operator'), options.get('exclude_region')
         if operators:
-            filters = Q()
-            for operator in operators:
-                filters |= Q(operator__name__icontains=operator)
-            ranges = ranges.filter(filters)
+            ranges = ranges.filter(operator_id__in=operator_cache.search(operators))
         if regions:
-            filters = Q()
-            for region in regions:
-                filters |= Q(region__name__icontains=region)
-            ranges = ranges.filter(filters)
+            ranges = ranges.filter(region_id__in=region_cache.search(regions))
         if exclude_operators:
-            filters = Q()
-            for operator in exclude_operators:
-                filters |= Q(operator__name__icontains=operator)
-            ranges = ranges.exclude(filters)
+            ranges = ranges.exclude(operator_id__in=operator_cache.search(exclude_operators))
         if exclude_regions:
-            filters = Q()
-            for region in exclude_regions:
-                filters |= Q(region__name__icontains=region)
-            ranges = ranges.exclude(filters)
+            ranges = ranges.exclude(region_id__in=region_cache.search(exclude_regions))
 
         return ranges.select_related('numbering_plan', 'operator', 'region')
 
     def handle_list_plan_ranges(self, args, options):
+        """
+        Lists ranges with keyset pagination (see `rfnumplan.pagination`): --page and --after pages are fetched
+        by a seek from the key of the previous row, which is printed after every full page for the next --after.
+        Without them all ranges are streamed in tables of RFNUMPLAN_LIST_CHUNK_SIZE rows.
+        """
+        from rfnumplan.pagination import keyset_pages, keyset_page, row_key, format_key, parse_key, RANGE_KEYS
         ranges = self.get_plan_ranges_queryset(options)
         ranges = self.filter_plan_ranges_queryset(ranges, options)
 
         fields = ['numbering_plan__prefix', 'prefix', 'range_start', 'range_end', 'range_capacity', 'operator__name',
                   'region__name']
         header = [_('#'), _('###'), _('Start'), _('End'), _('Capacity'), _('Operator'), _('Region')]
-        ranges_data = []
-
-        page = self.paginated(ranges.values(*fields), options)
-        for r in page.object_list:
-            r['range_start'] = str(r['range_start'])[1:]
-            r['range_end'] = str(r['range_end'])[1:]
-            r['operator__name'] = truncatechars(r['operator__name'], 40)
-            ranges_data.append([r[field] for field in fields])
-
-        data = [header, *ranges_data]
-        if not options.get('page'):
-            title = str(_('Numbering plan ranges [x%s]')) % page.paginator.count
-        else:
-            title = str(_('Numbering plan ranges [x%(count)s], page %(page)s of %(num_pages)s')) % {
-                'count': page.paginator.count,
-                'page': options.get('page'),
-                'num_pages': page.paginator.num_pages
-            }
+        ranges = ranges.values(*fields, *RANGE_KEYS)
+        count = self.count_plan_ranges(options)
 
-        self.log(SingleTable(data, title=title).table, clr='DEFAULT')
+        def rows(page):
+            # rows are formatted into copies, page keys are needed intact for the next seek
+            for r in page:
+                r = dict(r, range_start=str(r['range_start'])[1:], range_end=str(r['range_end'])[1:],
+                         operator__name=truncatechars(r['operator__name'], 40))
+                yield [r[field] for field in fields]
 
-    def handle_update(self, force=False):
+        page_num = int(options.get('page'))
+        after = options.get('after')
+        if page_num or after:
+            try:
+                after = parse_key(after) if after else None
+            except ValueError as e:
+                raise CommandError(_('Invalid --after key: %s') % e)
+            page_size = int(options.get('page_size') or PAGE_SIZE)
+            if after:
+                title = str(_('Numbering plan ranges [x%(count)s] after %(key)s')) % {
+                    'count': count,
+                    'key': format_key(after),
+                }
+            else:
+                title = str(_('Numbering plan ranges [x%(count)s], page %(page)s of %(num_pages)s')) % {
+                    'count': count,
+                    'page': page_num,
+                    'num_pages': max(-(-count // page_size), 1),
+                }
+            page = keyset_page(ranges, max(page_num, 1), page_size, after=after)
+            self.log(SingleTable([header, *rows(page)], title=title).table, clr='DEFAULT')
+            if len(page) == page_size:
+                self.log(_('Next page: --after %s') % format_key(row_key(page[-1], RANGE_KEYS)))
+            return
+
+        title = str(_('Numbering plan ranges [x%s]')) % count
+        for page in keyset_pages(ranges, LIST_CHUNK_SIZE):
+            self.log(SingleTable([header, *rows(page)], title=title).table, clr='DEFAULT')
+            title = None
+
+    def handle_update(self, force=False, incremental=False, jobs=1):
+        """
+        Downloads plans in a pool of `jobs` threads and imports each one as soon as it is fetched,
+        so parsing and database writes of one plan overlap with downloads of the others.
+        Database writes stay serialized in the main thread.
+        """
         from rfnumplan.models import NumberingPlan
-        for np in NumberingPlan.objects.all():
-            self.log(_('%(force)sLoading `%(name)s` numbering plan...') % {
-                'force': _('[FORCE] ') if force else '',
-                'name': np,
-            })
-            objects = np.do_import(force=force)
-            self.log(_('Loaded %s objects') % len(objects), clr='SUCCESS')
+
+        def fetch(np):
+            started = time.monotonic()
+            return np.fetch(), time.monotonic() - started
+
+        started, failed = time.monotonic(), []
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            futures = {pool.submit(fetch, np): np for np in NumberingPlan.objects.all()}
+            for future in as_completed(futures):
+                np = futures[future]
+                try:
+                    fetched, fetch_time = future.result()
+                except Exception as e:
+                    self.err(_('Failed to fetch `%(name)s`: %(error)s') % {'name': np, 'error': e})
+                    failed.append(np)
+                    continue
+
+                self.log(_('%(force)sLoading `%(name)s` numbering plan (fetched in %(time).2fs%(cached)s)...') % {
+                    'force': _('[FORCE] ') if force else '',
+                    'name': np,
+                    'time': fetch_time,
+                    'cached': '' if fetched.modified else str(_(', not modified')),
+                })
+                load_started = time.monotonic()
+                stats = np.load(fetched, force=force, incremental=incremental)
+                np.save()
+                self.log(_('Created %(created)s, updated %(updated)s, deleted %(deleted)s, unchanged %(unchanged)s')
+                         % stats._asdict(), clr='SUCCESS', ending=' ')
+                self.log(_('in %.2fs') % (time.monotonic() - load_started), clr='DEFAULT')
+
+        self.log(_('Updated in %.2fs') % (time.monotonic() - started))
+        if failed:
+            raise CommandError(_('Failed to update: %s') % ', '.join(map(str, failed)))
+
+    def handle_snapshot(self, path: str):
+        from rfnumplan.snapshot import write_snapshot
+        started = time.monotonic()
+        count = write_snapshot(path)
+        self.log(_('%(count)s ranges written into %(file)s in %(time).2fs') % {
+            'count': count, 'file': path, 'time': time.monotonic() - started
+        }, clr='SUCCESS')
 
     def handle_clear(self):
         import rfnumplan.models as m
         self.log(_('Removing all data'), clr='ERROR')
+        # ranges go first and in batches, so deleting regions and operators has nothing left to cascade to
+        with m.range_signals_muted():
+            m.delete_in_batches(m.NumberingPlanRange.objects.all())
+        m.NumberingPlanStats.objects.all().delete()
         m.Region.objects.all().delete()
         m.Operator.objects.all().delete()
-        m.NumberingPlanRange.objects.all().delete()
+        # plans have nothing loaded anymore, so the next --update must not be skipped as unchanged
+        m.NumberingPlan.objects.update(loaded=False, content_hash='', etag='')
+        bump_data_version()
         # m.NumberingPlan.objects.all().delete()
         self.log(_('Removed all data'), clr='SUCCESS')
 
+    def handle_create_range_index(self):
+        from rfnumplan.rangedb import get_range_backend
+        backend = get_range_backend()
+        if backend is None:
+            raise CommandError(_('Native range index is not supported by %s') % connection.vendor)
+        started = time.monotonic()
+        backend.create_schema()
+        self.log(_('Range index %(table)s is ready in %(time).2fs') % {
+            'table': backend.table, 'time': time.monotonic() - started
+        }, clr='SUCCESS')
+
     def handle_range_summary(self, options):
-        header = [_('Numbering plan'), _('#'), _('###'), _('Count')]
+        header = [_('Numbering plan'), _('#'), _('###'), _('Count'), _('Capacity')]
         ranges_info = []
         for np in self.get_plans_qs(options):
-            for rp in sorted(np.range_prefixes(), reverse=True, key=lambda tup: tup[1]):
-                ranges_info.append([np.name, np.prefix, rp[0], rp[1]])
+            for prefix, count, capacity in np.range_prefixes().order_by('-cnt', 'prefix'):
+                ranges_info.append([np.name, np.prefix, prefix, count, capacity])
 
         data = [header, *ranges_info]
         title = str(_('Plan range prefixes summary'))
         self.log(SingleTable(data, title=title).table, clr='DEFAULT')
 
     def write_csv_ranges(self, ranges, options):
-        field_names = ['prefix', 'operator', 'region']
-        cost, price = options.get('cost'), options.get('price')
-        if cost:
-            field_names.append('cost')
-        if price:
-            field_names.append('price')
-
-        counter = 0
+        extra_fields = {}
+        if options.get('cost'):
+            extra_fields['cost'] = options.get('cost')
+        if options.get('price'):
+            extra_fields['price'] = options.get('price')
+
         csv_file_path = options.get('csv')
-        with open(csv_file_path, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=field_names)
-            writer.writeheader()
-
-            for nr in tqdm(ranges):
-                for prefix in nr.to_prefix_list():
-                    bundle = {
-                        'prefix': prefix,
-                        'operator': nr.operator.name,
-                        'region': nr.region.name
-                    }
-                    if cost:
-                        bundle['cost'] = cost
-                    if price:
-                        bundle['price'] = price
-                    writer.writerow(bundle)
-                    counter += 1
-            self.log(_('%(count)s rows written into %(file)s') % {'count': counter, 'file': csv_file_path})
+        counter = write_prefixes(
+            ranges, csv_file_path,
+            fmt=options.get('format'),
+            extra_fields=extra_fields,
+            coalesce=options.get('coalesce'),
+            collapse=options.get('collapse'),
+            jobs=options.get('jobs'),
+            progress=tqdm,
+        )
+        self.log(_('%(count)s rows written into %(file)s') % {'count': counter, 'file': csv_file_path})
 
     def handle_prefixes(self, options):
         ranges = self.get_plan_ranges_queryset(options)
@@ -283,6 +390,9 @@ class Command(BaseCommand):
         self.log(_('Found numbering plan ranges:'))
         for num in phones:
             fi = self.get_phone_info(num)
+            if fi['ported']:
+                self.log(fi['e164'], clr='ERROR', ending='\t')
+                self.log(_('ported to %s') % fi['ported'], clr='INFO', ending='\n')
             for nr in fi['info']:
                 self.log(fi['e164'], clr='ERROR', ending='\t')
                 self.log(nr.get_display(), ending='\n\t')
@@ -290,9 +400,84 @@ class Command(BaseCommand):
                 self.log(nr.region, clr='SUCCESS', ending='\n')
                 # self.log(', '.join(nr.to_prefix_list()), clr='SUCCESS', ending='\n\t')
 
+    def handle_portability(self, options):
+        from rfnumplan.portability import import_registry
+        if not PORTABILITY_PATH:
+            raise CommandError(_('RFNUMPLAN_PORTABILITY_PATH is not set'))
+
+        files = [(options.get('portability'), False)] if options.get('portability') else []
+        files += [(path, True) for path in options.get('portability_delta')]
+        for path, delta in files:
+            started = time.monotonic()
+            with open(path, 'r', encoding='utf-8', newline='') as lines:
+                overlay = import_registry(lines, delta=delta)
+            self.log(_('%(file)s applied in %(time).2fs, %(count)s ported numbers') % {
+                'file': path, 'time': time.monotonic() - started, 'count': len(overlay)
+            }, clr='SUCCESS')
+
+    def handle_bulk_lookup(self, options):
+        from rfnumplan.bulk import bulk_lookup
+        input_path, output_path = options.get('input'), options.get('output')
+        started = time.monotonic()
+
+        def progress(totals):
+            self.err(_('%(total)s numbers, %(rate)d/s') % {
+                'total': totals['total'], 'rate': totals['total'] / max(time.monotonic() - started, 1e-6)
+            }, clr='INFO', ending='\r')
+
+        lines = sys.stdin if input_path == '-' else open(input_path, 'r', encoding='utf-8', newline='')
+        output = open_output(output_path) if output_path else sys.stdout
+        try:
+            totals = bulk_lookup(lines, output, fmt=options.get('format'), jobs=options.get('jobs'),
+                                 chunk_size=BULK_CHUNK_SIZE, progress=progress)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+            if output is not sys.stdout:
+                output.close()
+
+        elapsed = time.monotonic() - started
+        self.err(_('%(total)s numbers in %(time).2fs (%(rate)d/s): found %(found)s, not found %(not_found)s, '
+                   'invalid %(invalid)s') % {
+            'total': totals['total'],
+            'time': elapsed,
+            'rate': totals['total'] / max(elapsed, 1e-6),
+            'found': totals.get(FOUND, 0),
+            'not_found': totals.get(NOT_FOUND, 0),
+            'invalid': totals.get(INVALID, 0),
+        }, clr='SUCCESS')
+
+    def print_profile(self, sink):
+        header = [_('Phase'), _('Calls'), _('Total, s'), _('Mean, ms'), _('Max, ms')]
+        timers = sorted(sink.items(TIMER), key=lambda item: -item[1].total)
+        data = [header, *([name, a.count, '%.3f' % a.total, '%.3f' % (a.mean * 1000), '%.3f' % (a.max * 1000)]
+                          for name, a in timers)]
+        self.err(SingleTable(data, title=str(_('Profile'))).table, clr='DEFAULT')
+
+        other = [[name, a.kind, a.count, a.total, a.min, a.max] for name, a in sink.items() if a.kind != TIMER]
+        if other:
+            header = [_('Metric'), _('Kind'), _('Count'), _('Sum'), _('Min'), _('Max')]
+            self.err(SingleTable([header, *other]).table, clr='DEFAULT')
+
     def handle(self, *args, **options):
         activate(options.get('locale'))
 
+        profile = options.get('profile')
+        if profile is None:
+            return self.handle_command(args, options)
+
+        with collect() as sink:
+            if profile:
+                profiler = cProfile.Profile()
+                profiler.runcall(self.handle_command, args, options)
+                profiler.dump_stats(profile)
+            else:
+                self.handle_command(args, options)
+        self.print_profile(sink)
+        if profile:
+            self.err(_('cProfile stats written into %s') % profile, clr='INFO')
+
+    def handle_command(self, args, options):
         if options.get('prefixes'):
             self.handle_prefixes(options)
             return
@@ -312,8 +497,27 @@ class Command(BaseCommand):
         if options.get('clear'):
             self.handle_clear()
 
+        if options.get('create_range_index'):
+            self.handle_create_range_index()
+            return
+
         if options.get('update'):
-            self.handle_update(force=options.get('force'))
+            self.handle_update(force=options.get('force'), incremental=options.get('incremental'),
+                               jobs=options.get('jobs'))
+            if options.get('snapshot') or SNAPSHOT_PATH:
+                self.handle_snapshot(options.get('snapshot') or SNAPSHOT_PATH)
+            return
+
+        if options.get('snapshot'):
+            self.handle_snapshot(options.get('snapshot'))
+            return
+
+        if options.get('portability') or options.get('portability_delta'):
+            self.handle_portability(options)
+            return
+
+        if options.get('input'):
+            self.handle_bulk_lookup(options)
             return
 
         if options.get('phones'):
@@ -0,0 +1,206 @@
+import asyncio
+import gc
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from terminaltables import SingleTable
+
+from django.db import connection
+from django.utils.translation import ugettext_lazy as _
+from django.core.management.base import BaseCommand, CommandError
+
+from rfnumplan.synthetic import write_plan_csv, random_numbers
+
+BENCHMARKS = ('import', 'import_incremental', 'import_memory', 'index_build', 'lookup_db', 'lookup_db_native',
+              'lookup_index', 'lookup_cached', 'lookup_trie', 'lookup_batch', 'afind_concurrent', 'range_to_prefix', 'export')
+
+# results of these are compared by peak memory instead of time
+MEMORY_BENCHMARKS = ('import_memory',)
+
+
+class Command(BaseCommand):
+    help = str(_('Benchmarks lookups, import and export on a generated plan in a temporary test database. Example:\n'
+                 ' python manage.py rfnumplan_bench --baseline bench.json'))
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ranges', type=int, default=20000, dest='ranges',
+                            help=str(_('Number of ranges in the generated plan')))
+        parser.add_argument('--operators', type=int, default=50, dest='operators',
+                            help=str(_('Number of operators in the generated plan')))
+        parser.add_argument('--regions', type=int, default=85, dest='regions',
+                            help=str(_('Number of regions in the generated plan')))
+        parser.add_argument('--lookups', type=int, default=5000, dest='lookups',
+                            help=str(_('Number of numbers to look up')))
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size',
+                            help=str(_('Batch size for batch lookups')))
+        parser.add_argument('--concurrency', type=int, default=500, dest='concurrency',
+                            help=str(_('Number of concurrent async lookups')))
+        parser.add_argument('--seed', type=int, default=0, dest='seed',
+                            help=str(_('Random seed of the generated plan and numbers')))
+        parser.add_argument('--only', action='append', default=[], choices=BENCHMARKS, dest='only',
+                            help=str(_('Run only given benchmark(s)')))
+        parser.add_argument('--baseline', dest='baseline',
+                            help=str(_('JSON file with baseline results to compare with')))
+        parser.add_argument('--save-baseline', action='store_true', default=False, dest='save_baseline',
+                            help=str(_('Store results into --baseline file')))
+        parser.add_argument('--threshold', type=float, default=0.25, dest='threshold',
+                            help=str(_('Allowed slowdown against baseline, 0.25 = 25%%')))
+        parser.add_argument('--generate', dest='generate', metavar='PATH',
+                            help=str(_('Only write a generated plan csv into PATH')))
+
+    def handle(self, *args, **options):
+        self.options = options
+        plan_kwargs = {'operators': options['operators'], 'regions': options['regions'], 'seed': options['seed']}
+
+        if options['generate']:
+            written = write_plan_csv(options['generate'], options['ranges'], **plan_kwargs)
+            self.stdout.write('%s ranges written to %s' % (written, options['generate']))
+            return
+
+        if options['save_baseline'] and not options['baseline']:
+            raise CommandError(_('--save-baseline requires --baseline'))
+
+        from django.test.runner import DiscoverRunner
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        workdir = tempfile.mkdtemp(prefix='rfnumplan-bench-')
+        try:
+            results = self.run_benchmarks(workdir, plan_kwargs)
+            vendor = connection.vendor
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            runner.teardown_databases(old_config)
+
+        params = {k: options[k] for k in ('ranges', 'operators', 'regions', 'lookups', 'batch_size',
+                                          'concurrency', 'seed')}
+        baseline = self.read_baseline()
+        regressions = self.report(results, baseline.get(vendor), params)
+
+        if options['save_baseline']:
+            baseline[vendor] = {'params': params, 'results': results}
+            with open(options['baseline'], 'w') as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+            self.stdout.write('baseline for %s saved to %s' % (vendor, options['baseline']))
+        elif regressions:
+            raise CommandError('regressed: %s' % ', '.join(regressions))
+
+    def read_baseline(self) -> dict:
+        path = self.options['baseline']
+        if not path or not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def report(self, results: dict, baseline: dict, params: dict) -> list:
+        """
+        Prints results table and compares it with `baseline` of the same database vendor
+        :return: names of benchmarks that regressed past --threshold
+        """
+        if baseline and baseline['params'] != params:
+            raise CommandError(_('baseline was recorded with different parameters: %s') % baseline['params'])
+        base = baseline['results'] if baseline else {}
+        threshold = self.options['threshold']
+
+        regressions = []
+        table = [['benchmark', 'ops', 'seconds', 'ops/s', 'peak, KiB', 'baseline', 'change']]
+        for name, res in results.items():
+            metric = 'peak_kib' if name in MEMORY_BENCHMARKS else 'seconds'
+            row = [name, res['ops'], '%.4f' % res['seconds'], '%.0f' % res['ops_per_sec'], res.get('peak_kib', ''),
+                   '', '']
+            if name in base:
+                change = res[metric] / base[name][metric] - 1 if base[name][metric] else 0
+                row[5] = base[name][metric]
+                row[6] = '%+.1f%%' % (change * 100)
+                if change > threshold:
+                    regressions.append(name)
+                    row[6] += ' !'
+            table.append(row)
+        self.stdout.write(SingleTable(table, title=connection.vendor).table)
+        return regressions
+
+    def run_benchmarks(self, workdir: str, plan_kwargs: dict) -> dict:
+        from rfnumplan.models import NumberingPlan, NumberingPlanRange
+        from rfnumplan.index import get_index, reset_index
+        from rfnumplan.cache import cached_find, lookup_cache
+        from rfnumplan.trie import get_trie
+        from rfnumplan.aio import afind
+        from rfnumplan.rangedb import get_range_backend
+        from rfnumplan.utils import ranges_to_prefixes
+        from rfnumplan.export import write_prefixes
+
+        options = self.options
+        only = set(options['only'] or BENCHMARKS)
+        results = {}
+
+        def bench(name, ops, func, *args):
+            if name not in only:
+                return None
+            gc.collect()
+            started = time.perf_counter()
+            value = func(*args)
+            seconds = time.perf_counter() - started
+            results[name] = {'ops': ops, 'seconds': round(seconds, 6), 'ops_per_sec': round(ops / seconds, 1)}
+            return value
+
+        def make_plan(name, codes):
+            path = os.path.join(workdir, '%s.csv' % name)
+            count = write_plan_csv(path, options['ranges'], codes=codes, **plan_kwargs)
+            # bulk_create skips `NumberingPlan.save`, which would import the plan right away
+            NumberingPlan.objects.bulk_create([NumberingPlan(name=name, prefix=7, plan_uri='file://' + path)])
+            return NumberingPlan.objects.get(name=name), count
+
+        plan, count = make_plan('9xx', range(900, 1000))
+        # the plan is needed by every other benchmark, so it is imported even when not measured
+        if 'import' in only:
+            bench('import', count, plan.do_import, True)
+        else:
+            plan.do_import(force=True)
+        bench('import_incremental', count, plan.do_import, True, True)
+
+        if 'import_memory' in only:
+            memory_plan, memory_count = make_plan('3xx', range(300, 400))
+            tracemalloc.start()
+            bench('import_memory', memory_count, memory_plan.do_import, True)
+            results['import_memory']['peak_kib'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+
+        numbers = random_numbers(options['lookups'], seed=options['seed'])
+        reset_index()
+        index = bench('index_build', count, get_index) or get_index()
+
+        bench('lookup_db', len(numbers), lambda: [list(NumberingPlanRange.find(n, native=False)) for n in numbers])
+        backend = get_range_backend()
+        if backend and 'lookup_db_native' in only:
+            backend.create_schema()
+            bench('lookup_db_native', len(numbers),
+                  lambda: [list(NumberingPlanRange.find(n, native=True)) for n in numbers])
+        bench('lookup_index', len(numbers), lambda: [index.find(n) for n in numbers])
+        lookup_cache.clear()
+        bench('lookup_cached', len(numbers), lambda: [cached_find(n) for n in numbers])
+        trie = get_trie()
+        bench('lookup_trie', len(numbers), lambda: [trie.lookup(n) for n in numbers])
+
+        batch_size = options['batch_size']
+        bench('lookup_batch', len(numbers),
+              lambda: [index.find_many(numbers[i:i + batch_size]) for i in range(0, len(numbers), batch_size)])
+
+        async def concurrent_lookups(batch):
+            return await asyncio.gather(*(afind(n) for n in batch))
+
+        concurrent = numbers[:options['concurrency']]
+        loop = asyncio.new_event_loop()
+        try:
+            bench('afind_concurrent', len(concurrent), lambda: loop.run_until_complete(concurrent_lookups(concurrent)))
+        finally:
+            loop.close()
+
+        pairs = list(plan.ranges.active().values_list('number_start', 'number_end'))
+        bench('range_to_prefix', len(pairs), ranges_to_prefixes, pairs)
+
+        ranges = NumberingPlanRange.objects.active().select_related('operator', 'region')
+        bench('export', count, write_prefixes, ranges, os.path.join(workdir, 'prefixes.csv'))
+        return results
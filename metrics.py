@@ -0,0 +1,158 @@
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+from .settings import METRICS_SINKS, METRICS_PREFIX, METRICS_STATSD_ADDRESS
+
+TIMER, COUNTER, HISTOGRAM = 'timer', 'counter', 'histogram'
+
+# sent for every recorded metric with kind (TIMER, COUNTER or HISTOGRAM), name, value and tags;
+# timer values are in seconds
+metric_recorded = Signal()
+
+logger = logging.getLogger('rfnumplan.metrics')
+
+
+class LoggingSink(object):
+    """
+    Writes every metric into `rfnumplan.metrics` logger at DEBUG level
+    """
+
+    def record(self, kind: str, name: str, value, tags: dict):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s %s=%s %s', kind, name, value, tags or '')
+
+
+class StatsdSink(object):
+    """
+    Sends metrics to a statsd-compatible daemon over UDP (RFNUMPLAN_METRICS_STATSD_ADDRESS),
+    tags in the dogstatsd `|#key:value` form. Sending never blocks nor raises.
+    """
+
+    types = {TIMER: 'ms', COUNTER: 'c', HISTOGRAM: 'h'}
+
+    def __init__(self, address=METRICS_STATSD_ADDRESS, prefix=METRICS_PREFIX):
+        self.address = address
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def record(self, kind: str, name: str, value, tags: dict):
+        if kind == TIMER:
+            value = value * 1000
+        line = '%s%s:%g|%s' % (self.prefix, name, value, self.types[kind])
+        if tags:
+            line += '|#' + ','.join('%s:%s' % item for item in sorted(tags.items()))
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+
+class Aggregate(object):
+    __slots__ = ('kind', 'count', 'total', 'min', 'max')
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.count = self.total = 0
+        self.min = self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+class MemorySink(object):
+    """
+    Aggregates metrics in memory by name: count, total, min, max
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.aggregates = {}
+
+    def record(self, kind: str, name: str, value, tags: dict):
+        with self.lock:
+            aggregate = self.aggregates.get(name)
+            if aggregate is None:
+                aggregate = self.aggregates[name] = Aggregate(kind)
+            aggregate.add(value)
+
+    def items(self, kind: str = None) -> list:
+        """
+        :return: sorted (name, `Aggregate`) pairs, only of `kind` if given
+        """
+        return sorted((name, a) for name, a in self.aggregates.items() if kind is None or a.kind == kind)
+
+
+sinks = [import_string(path)() for path in METRICS_SINKS]
+
+
+def record(kind: str, name: str, value, tags: dict = None):
+    for sink in sinks:
+        sink.record(kind, name, value, tags)
+    if metric_recorded.has_listeners():
+        metric_recorded.send(sender=None, kind=kind, name=name, value=value, tags=tags)
+
+
+def incr(name: str, value=1, **tags):
+    record(COUNTER, name, value, tags)
+
+
+def observe(name: str, value, **tags):
+    record(HISTOGRAM, name, value, tags)
+
+
+@contextmanager
+def timer(name: str, **tags):
+    """
+    Records the duration of the block in seconds:
+        with timer('import.insert', plan='9xx'):
+            ...
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(TIMER, name, time.perf_counter() - started, tags)
+
+
+def timed_iter(iterable, name: str, **tags) -> iter:
+    """
+    Yields items of `iterable` and records the total time spent producing them, e.g. lazy parsing
+    """
+    elapsed = 0
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            record(TIMER, name, elapsed + time.perf_counter() - started, tags)
+            return
+        elapsed += time.perf_counter() - started
+        yield item
+
+
+@contextmanager
+def collect(sink=None):
+    """
+    Temporarily adds `sink` (a new `MemorySink` by default) to the active sinks
+    """
+    sink = sink or MemorySink()
+    sinks.append(sink)
+    try:
+        yield sink
+    finally:
+        sinks.remove(sink)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from rfnumplan.settings import IMPORT_BATCH_SIZE
+from rfnumplan.utils import chunked
+
+
+def fill_number_range(apps, schema_editor):
+    NumberingPlanRange = apps.get_model('rfnumplan', 'NumberingPlanRange')
+    ranges = NumberingPlanRange.objects.order_by().values_list(
+        'pk', 'numbering_plan__prefix', 'prefix', 'range_start', 'range_end'
+    )
+    sql = 'UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s' % tuple(map(schema_editor.quote_name, (
+        NumberingPlanRange._meta.db_table, 'number_start', 'number_end', NumberingPlanRange._meta.pk.column,
+    )))
+    # one executemany per batch instead of a round trip per row
+    with schema_editor.connection.cursor() as cursor:
+        for chunk in chunked(ranges.iterator(), IMPORT_BATCH_SIZE):
+            cursor.executemany(sql, [
+                (
+                    int('%s%s%s' % (plan_prefix, prefix, str(range_start)[1:])),
+                    int('%s%s%s' % (plan_prefix, prefix, str(range_end)[1:])),
+                    pk,
+                )
+                for pk, plan_prefix, prefix, range_start, range_end in chunk
+            ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rfnumplan', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='numberingplanrange',
+            options={'ordering': ['numbering_plan_id', 'prefix', 'range_start'], 'verbose_name': 'numbering plan range', 'verbose_name_plural': 'numbering plan ranges'},
+        ),
+        migrations.AddField(
+            model_name='numberingplanrange',
+            name='number_end',
+            field=models.BigIntegerField(editable=False, help_text='full range end, e.g. 79005555549', null=True, verbose_name='number end'),
+        ),
+        migrations.AddField(
+            model_name='numberingplanrange',
+            name='number_start',
+            field=models.BigIntegerField(editable=False, help_text='full range start, e.g. 79005550000', null=True, verbose_name='number start'),
+        ),
+        migrations.AlterField(
+            model_name='numberingplanrange',
+            name='numbering_plan',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranges', to='rfnumplan.NumberingPlan', verbose_name='numbering plan'),
+        ),
+        migrations.RunPython(fill_number_range, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='numberingplanrange',
+            index_together=set([('number_start', 'number_end')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rfnumplan', '0002_numberingplanrange_number_range'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='numberingplan',
+            name='active_generation',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='generation of ranges visible to lookups', verbose_name='active generation'),
+        ),
+        migrations.AddField(
+            model_name='numberingplanrange',
+            name='generation',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='generation'),
+        ),
+        migrations.AlterIndexTogether(
+            name='numberingplanrange',
+            index_together=set([('number_start', 'number_end'), ('numbering_plan', 'generation')]),
+        ),
+    ]
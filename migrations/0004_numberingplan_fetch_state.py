@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rfnumplan', '0003_range_generations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='numberingplan',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, help_text='sha256 of the loaded file', max_length=64, verbose_name='content hash'),
+        ),
+        migrations.AddField(
+            model_name='numberingplan',
+            name='etag',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='etag'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_stats(apps, schema_editor):
+    NumberingPlanRange = apps.get_model('rfnumplan', 'NumberingPlanRange')
+    NumberingPlanStats = apps.get_model('rfnumplan', 'NumberingPlanStats')
+    rows = NumberingPlanRange.objects.filter(
+        generation=models.F('numbering_plan__active_generation')
+    ).order_by().values_list('numbering_plan_id', 'prefix', 'operator_id', 'region_id').annotate(
+        range_count=models.Count('pk'), capacity=models.Sum('range_capacity')
+    )
+    NumberingPlanStats.objects.bulk_create(
+        NumberingPlanStats(numbering_plan_id=plan_id, prefix=prefix, operator_id=operator_id, region_id=region_id,
+                           range_count=range_count, capacity=capacity)
+        for plan_id, prefix, operator_id, region_id, range_count, capacity in rows.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rfnumplan', '0004_numberingplan_fetch_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NumberingPlanStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.PositiveIntegerField(verbose_name='prefix')),
+                ('range_count', models.PositiveIntegerField(verbose_name='range count')),
+                ('capacity', models.BigIntegerField(verbose_name='capacity')),
+                ('numbering_plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='rfnumplan.NumberingPlan', verbose_name='numbering plan')),
+                ('operator', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rfnumplan.Operator', verbose_name='operator')),
+                ('region', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rfnumplan.Region', verbose_name='region')),
+            ],
+            options={
+                'verbose_name': 'numbering plan statistics',
+                'verbose_name_plural': 'numbering plan statistics',
+                'ordering': ['numbering_plan_id', 'prefix'],
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
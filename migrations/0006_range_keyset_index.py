@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:26
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rfnumplan', '0005_numberingplanstats'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='numberingplanrange',
+            index_together=set([('numbering_plan', 'generation'), ('numbering_plan', 'prefix', 'range_start'), ('number_start', 'number_end')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def create_version(apps, schema_editor):
+    DataVersion = apps.get_model('rfnumplan', 'DataVersion')
+    DataVersion.objects.create(pk=1, version=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rfnumplan', '0006_range_keyset_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0, verbose_name='version')),
+            ],
+            options={
+                'verbose_name': 'data version',
+                'verbose_name_plural': 'data versions',
+            },
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
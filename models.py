@@ -1,17 +1,30 @@
-import phonenumbers
-import requests
-import dateutil.parser
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 
-from django.core.files.temp import NamedTemporaryFile
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.forms import model_to_dict
 
-from rfnumplan.utils import read_csv_num_plan, map_instances_by_name, range_to_prefix
+from rfnumplan.utils import iter_csv_num_plan, chunked, range_to_prefix, absolute_number
 from django.utils.translation import ugettext_lazy as _
 
-from .settings import MAX_PREFIX_LENGTH
+from .cache import bump_data_version
+from .dimensions import operator_cache, region_cache
+from .fetch import PlanFetcher, FetchResult
+from .metrics import timer, timed_iter, observe
+from .normalize import normalize
+from .rangedb import get_range_backend
+from .settings import MAX_RANGE_CAPACITY, FIND_LIMIT, IMPORT_BATCH_SIZE, GC_IN_BACKGROUND, NATIVE_RANGE_INDEX
+
+
+ImportStats = namedtuple('ImportStats', ['created', 'updated', 'deleted', 'unchanged'])
+
+# per-thread state of `range_changed` receiver
+_range_signals = threading.local()
 
 
 class ModelDiffMixin(object):
@@ -87,6 +100,11 @@ class NumberingPlan(ModelDiffMixin, models.Model):
     plan_uri = models.URLField(_('url'), blank=True)
     loaded = models.BooleanField(_('loaded'), default=False)
     last_modified = models.DateTimeField(_('last modified'), blank=True, null=True)
+    etag = models.CharField(_('etag'), max_length=255, blank=True, editable=False)
+    content_hash = models.CharField(_('content hash'), max_length=64, blank=True, editable=False,
+                                    help_text=_('sha256 of the loaded file'))
+    active_generation = models.PositiveIntegerField(_('active generation'), default=0, editable=False,
+                                                    help_text=_('generation of ranges visible to lookups'))
 
     class Meta:
         verbose_name = _('numbering plan')
@@ -96,39 +114,209 @@ class NumberingPlan(ModelDiffMixin, models.Model):
     def __str__(self):
         return self.name
 
-    def do_import(self, force=False):
-        head = requests.head(self.plan_uri).headers
-        lm = dateutil.parser.parse(head.get('Last-Modified'))
-        if self.last_modified and self.last_modified >= lm and not force and self.loaded:
-            return []
-
-        response = requests.get(self.plan_uri)
-        tmp = NamedTemporaryFile(delete=True)
-        tmp.write(response.content)
-        tmp.flush()
-
-        parsed = read_csv_num_plan(tmp.name)
-        operators = map_instances_by_name(Operator, parsed['operators'])
-        regions = map_instances_by_name(Region, parsed['regions'])
-        NumberingPlanRange.objects.filter(numbering_plan=self).delete()
-
-        bulk = []
-        for bundle in parsed['data']:
-            bulk.append(
-                NumberingPlanRange(
-                    numbering_plan=self,
-                    prefix=bundle['prefix'],
-                    range_start='1%s' % bundle['range_start'],
-                    range_end='1%s' % bundle['range_end'],
-                    range_capacity=bundle['range_capacity'],
-                    operator=operators[bundle['operator']],
-                    region=regions[bundle['region']],
+    def do_import(self, force=False, incremental=False) -> ImportStats:
+        """
+        Fetches plan csv from `plan_uri` (see `rfnumplan.fetch.PlanFetcher`) and stores its ranges
+        in batches of RFNUMPLAN_IMPORT_BATCH_SIZE. The file is parsed lazily, so neither its content
+        nor the parsed rows are kept in memory as a whole.
+        Import is skipped if the fetched file has the same hash as the loaded one, unless `force` is set.
+        :param incremental: diff the file against stored ranges by (prefix, range_start, range_end)
+                            and touch only changed rows instead of replacing the whole plan
+        """
+        return self.load(self.fetch(), force=force, incremental=incremental)
+
+    def fetch(self) -> FetchResult:
+        """
+        Downloads plan file into the local cache. Does not touch the database, so it is safe to call from threads.
+        """
+        with timer('import.fetch', plan=self.name):
+            return PlanFetcher().fetch(self.plan_uri)
+
+    def load(self, fetched: FetchResult, force=False, incremental=False) -> ImportStats:
+        """
+        Imports previously fetched plan file, see `do_import`
+        """
+        if self.loaded and fetched.content_hash == self.content_hash and not force:
+            return ImportStats(0, 0, 0, 0)
+
+        with timer('import.load', plan=self.name), open(fetched.path, 'r', encoding='cp1251', newline='') as lines:
+            bundles = timed_iter(iter_csv_num_plan(lines), 'import.parse', plan=self.name)
+            if incremental:
+                with transaction.atomic():
+                    stats = self.import_incremental(bundles)
+            else:
+                stats = self.import_full(bundles)
+        observe('import.rows', stats.created + stats.updated + stats.unchanged, plan=self.name)
+
+        self.last_modified = fetched.last_modified
+        self.etag = fetched.etag
+        self.content_hash = fetched.content_hash
+        self.loaded = True
+        bump_data_version()
+        return stats
+
+    def iter_resolved_chunks(self, bundles, summary: dict = None) -> iter:
+        """
+        Yields (chunk, operators, regions): bundle chunks along with operator and region instances by name
+        that cover every bundle seen so far. Names are resolved through process-wide `rfnumplan.dimensions` caches.
+        :param summary: dict to accumulate [range count, capacity] by (prefix, operator id, region id) into
+        """
+        operators, regions = {}, {}
+        for chunk in chunked(bundles, IMPORT_BATCH_SIZE):
+            with timer('import.resolve', plan=self.name):
+                operators.update(operator_cache.get_or_create({b['operator'] for b in chunk} - operators.keys()))
+                regions.update(region_cache.get_or_create({b['region'] for b in chunk} - regions.keys()))
+            if summary is not None:
+                for b in chunk:
+                    totals = summary.setdefault(
+                        (int(b['prefix']), operators[b['operator']].pk, regions[b['region']].pk), [0, 0])
+                    totals[0] += 1
+                    totals[1] += int(b['range_capacity'])
+            yield chunk, operators, regions
+
+    def save_summary(self, summary: dict):
+        """
+        Replaces plan statistics with `summary`, see `iter_resolved_chunks`
+        """
+        with timer('import.summary', plan=self.name):
+            self.stats.all().delete()
+            NumberingPlanStats.objects.bulk_create(
+                NumberingPlanStats(numbering_plan=self, prefix=prefix, operator_id=operator_id, region_id=region_id,
+                                   range_count=count, capacity=capacity)
+                for (prefix, operator_id, region_id), (count, capacity) in summary.items()
+            )
+
+    def refresh_summary(self):
+        """
+        Recomputes plan statistics from stored ranges, e.g. after ranges were edited by hand
+        """
+        rows = self.ranges.active().order_by().values_list('prefix', 'operator_id', 'region_id').annotate(
+            count=models.Count('pk'), capacity=models.Sum('range_capacity'))
+        self.save_summary({row[:3]: row[3:] for row in rows})
+
+    def import_full(self, bundles) -> ImportStats:
+        """
+        Loads ranges into the next generation and then switches `active_generation` to it with a single update,
+        so lookups see either the old plan or the new one, never a partial or empty one.
+        The previous generation is garbage-collected afterwards, see `collect_generations`;
+        in the background only once the surrounding transaction, if any, is committed.
+        """
+        # leftovers of an interrupted import or of a collection that has not finished yet
+        with timer('import.delete', plan=self.name), range_signals_muted():
+            delete_in_batches(self.ranges.exclude(generation=self.active_generation))
+
+        generation = self.active_generation + 1
+        created = 0
+        summary = {}
+        for chunk, operators, regions in self.iter_resolved_chunks(bundles, summary):
+            with timer('import.insert', plan=self.name):
+                NumberingPlanRange.objects.bulk_create(
+                    self.make_range(bundle, operators, regions, generation=generation) for bundle in chunk
                 )
+            created += len(chunk)
+        self.sync_range_index()
+
+        with timer('import.switch', plan=self.name), transaction.atomic():
+            deleted = self.ranges.active().count()
+            NumberingPlan.objects.filter(pk=self.pk).update(active_generation=generation)
+            self.save_summary(summary)
+        self.active_generation = generation
+
+        if GC_IN_BACKGROUND:
+            # the thread has its own connection: it must not delete the old generation before the switch is committed
+            transaction.on_commit(
+                lambda: threading.Thread(target=self.collect_generations, kwargs={'close_connection': True}).start()
             )
+        else:
+            self.collect_generations()
 
-        self.last_modified = lm
-        self.loaded = True
-        return NumberingPlanRange.objects.bulk_create(bulk)
+        return ImportStats(created=created, updated=0, deleted=deleted, unchanged=0)
+
+    def collect_generations(self, close_connection=False):
+        """
+        Deletes ranges of inactive generations in batches of RFNUMPLAN_IMPORT_BATCH_SIZE
+        """
+        try:
+            with timer('import.gc', plan=self.name), range_signals_muted():
+                delete_in_batches(self.ranges.exclude(generation=self.active_generation))
+        finally:
+            if close_connection:
+                connection.close()
+
+    def import_incremental(self, bundles) -> ImportStats:
+        fields = ['prefix', 'range_start', 'range_end', 'pk', 'range_capacity', 'operator_id', 'region_id']
+        with timer('import.existing', plan=self.name):
+            existing = {
+                (prefix, range_start, range_end): (pk, capacity, operator_id, region_id)
+                for prefix, range_start, range_end, pk, capacity, operator_id, region_id
+                in self.ranges.active().order_by().values_list(*fields).iterator()
+            }
+
+        created = updated = unchanged = 0
+        summary = {}
+        for chunk, operators, regions in self.iter_resolved_chunks(bundles, summary):
+            bulk = []
+            for bundle in chunk:
+                nr = self.make_range(bundle, operators, regions, generation=self.active_generation)
+                key = (nr.prefix, int(nr.range_start), int(nr.range_end))
+                values = (int(nr.range_capacity), nr.operator.pk, nr.region.pk)
+                if key not in existing:
+                    bulk.append(nr)
+                    continue
+
+                pk, *stored_values = existing.pop(key)
+                if tuple(stored_values) == values:
+                    unchanged += 1
+                    continue
+
+                with timer('import.update', plan=self.name):
+                    NumberingPlanRange.objects.filter(pk=pk).update(
+                        range_capacity=values[0], operator_id=values[1], region_id=values[2]
+                    )
+                updated += 1
+
+            with timer('import.insert', plan=self.name):
+                NumberingPlanRange.objects.bulk_create(bulk)
+            created += len(bulk)
+
+        stale = [pk for pk, *_values in existing.values()]
+        with timer('import.delete', plan=self.name), range_signals_muted():
+            for ids in chunked(stale, IMPORT_BATCH_SIZE):
+                NumberingPlanRange.objects.filter(pk__in=ids).delete()
+        self.sync_range_index()
+        self.save_summary(summary)
+
+        return ImportStats(created=created, updated=updated, deleted=len(stale), unchanged=unchanged)
+
+    def sync_range_index(self):
+        """
+        Brings native range index in line with stored ranges of this plan, see `rfnumplan.rangedb`
+        """
+        backend = get_range_backend() if NATIVE_RANGE_INDEX else None
+        if backend:
+            with timer('import.sync_index', plan=self.name):
+                backend.sync(self.pk)
+
+    def make_range(self, bundle: dict, operators: dict, regions: dict, generation=0):
+        """
+        Builds unsaved range of this plan from parsed csv bundle
+        :param operators: operator instances by name
+        :param regions: region instances by name
+        :param generation: plan generation the range belongs to
+        """
+        range_start, range_end = '1%s' % bundle['range_start'], '1%s' % bundle['range_end']
+        return NumberingPlanRange(
+            numbering_plan=self,
+            prefix=int(bundle['prefix']),
+            range_start=range_start,
+            range_end=range_end,
+            range_capacity=bundle['range_capacity'],
+            number_start=absolute_number(self.prefix, bundle['prefix'], range_start),
+            number_end=absolute_number(self.prefix, bundle['prefix'], range_end),
+            operator=operators[bundle['operator']],
+            region=regions[bundle['region']],
+            generation=generation,
+        )
 
     def save(self, *args, **kwargs):
         cf = self.changed_fields
@@ -141,7 +329,18 @@ class NumberingPlan(ModelDiffMixin, models.Model):
         return res
 
     def range_prefixes(self):
-        return self.ranges.order_by('prefix').values_list('prefix').annotate(cnt=models.Count('prefix'))
+        """
+        :return: (prefix, range count, capacity) of active ranges by prefix, read from `NumberingPlanStats`
+        """
+        return self.stats.all().prefixes()
+
+
+class NumberingPlanRangeQuerySet(models.QuerySet):
+    def active(self):
+        """
+        Ranges of the active generation of their plans, i.e. what lookups are allowed to see
+        """
+        return self.filter(generation=models.F('numbering_plan__active_generation'))
 
 
 class NumberingPlanRange(models.Model):
@@ -150,69 +349,101 @@ class NumberingPlanRange(models.Model):
     range_start = models.PositiveIntegerField(_('range start'), help_text=_('`1`-prefixed range start'))
     range_end = models.PositiveIntegerField(_('range end'), help_text=_('`1`-prefixed range end'))
     range_capacity = models.PositiveIntegerField(_('range capacity'))
+    number_start = models.BigIntegerField(_('number start'), null=True, editable=False,
+                                          help_text=_('full range start, e.g. 79005550000'))
+    number_end = models.BigIntegerField(_('number end'), null=True, editable=False,
+                                        help_text=_('full range end, e.g. 79005555549'))
+
+    generation = models.PositiveIntegerField(_('generation'), default=0, editable=False)
 
     operator = models.ForeignKey(Operator, verbose_name=_('operator'))
     region = models.ForeignKey(Region, verbose_name=_('region'))
 
+    objects = NumberingPlanRangeQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('numbering plan range')
         verbose_name_plural = _('numbering plan ranges')
         ordering = ['numbering_plan_id', 'prefix', 'range_start']
+        index_together = [['number_start', 'number_end'], ['numbering_plan', 'generation'],
+                          ['numbering_plan', 'prefix', 'range_start']]
 
     def __str__(self):
         return '%s [%s; %s]' % (self.numbering_plan.name, str(self.range_start)[1:], str(self.range_end)[1:])
 
     @staticmethod
-    def find(phone_number: str):
-        """
-        7 9 252123399
-        7 92 52123399
-        7 925 2123399
-        7 9252 123399
-        79 2 52123399
-        79 25 2123399
-        79 252 123399
-        79 2521 23399
-        792 5 2123399
-        792 52 123399
-        792 521 23399
-        792 5212 3399
-        7925 2 123399
-        7925 21 23399
-        7925 212 3399
-        7925 2123 399
-        :param phone_number:
-        :return:
-        """
-
-        number = phonenumbers.parse(phone_number, region='RU')
-        if not phonenumbers.is_valid_number(number):
-            raise ValueError(_('Wrong number %s') % phone_number)
-
-        e164_number = phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164).lstrip('+')
-
-        lookup = models.Q()
-
-        for i in range(1, min(MAX_PREFIX_LENGTH, len(e164_number))):
-            plan_prefix = e164_number[:i]
-            rest = e164_number[i:]
-
-            for j in range(1, min(MAX_PREFIX_LENGTH, len(rest))):
-                pr_prefix = rest[:j]
-                local_phone = rest[j:]
-                lookup |= models.Q(
-                    numbering_plan__prefix=plan_prefix, prefix=pr_prefix,
-                    range_start__lte='1%s' % local_phone, range_end__gte='1%s' % local_phone
-                )
-        return NumberingPlanRange.objects.filter(lookup).select_related('operator', 'region')
+    def normalize(phone_number: str) -> str:
+        """
+        Returns E.164 digits of `phone_number` without leading `+`, see `rfnumplan.normalize.normalize`
+        :raises ValueError: if number is not valid
+        """
+        return normalize(phone_number)
+
+    @staticmethod
+    def find(phone_number: str, native: bool = NATIVE_RANGE_INDEX):
+        """
+        Finds ranges containing `phone_number` with a single predicate over the (number_start, number_end) index.
+        Range never spans more than RFNUMPLAN_MAX_RANGE_CAPACITY numbers, so the lower bound of `number_start`
+        keeps misses from scanning the whole index.
+        Ported numbers are not checked: ranges name the original owner, use `RangeIndex.find_many`
+        or `rfnumplan.portability.get_overlay` for the current operator.
+        :param phone_number: e.g. +79252123399
+        :param native: narrow candidates down with database-native interval index (PostgreSQL GiST over int8range,
+                       SQLite R*Tree), see `rfnumplan.rangedb`; ignored on other databases and until
+                       the index is created with `rfnumplan --create-range-index`
+        :return: queryset of matching ranges, the closest range start first
+        """
+        number = int(NumberingPlanRange.normalize(phone_number))
+        ranges = NumberingPlanRange.objects.active().filter(
+            number_start__lte=number,
+            number_start__gt=number - MAX_RANGE_CAPACITY,
+            number_end__gte=number,
+        )
+        backend = get_range_backend() if native else None
+        containing = backend.containing(number) if backend else None
+        if containing:
+            where, params = containing
+            ranges = ranges.extra(where=[where], params=params)
+        return ranges.order_by('-number_start').select_related('numbering_plan', 'operator', 'region')[:FIND_LIMIT]
+
+    @staticmethod
+    def find_many(phone_numbers) -> list:
+        """
+        Batch lookup over in-memory range index, see `rfnumplan.index.RangeIndex.find_many`
+        :return: list of `LookupResult(number, e164, status, ranges)` in the input order
+        """
+        from rfnumplan.index import get_index
+        return get_index().find_many(phone_numbers)
 
     @staticmethod
     def range_prefixes():
-        return NumberingPlanRange.objects.order_by('prefix').values_list('prefix').annotate(cnt=models.Count('prefix'))
+        return NumberingPlanStats.objects.prefixes()
+
+    @property
+    def number_range(self) -> tuple:
+        """
+        Returns absolute (start, end) numbers of the range, e.g. (79000000000, 79009999999)
+        """
+        return (
+            absolute_number(self.numbering_plan.prefix, self.prefix, self.range_start),
+            absolute_number(self.numbering_plan.prefix, self.prefix, self.range_end),
+        )
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            # ranges added one by one (admin, ORM) join the generation lookups currently see
+            self.generation = self.numbering_plan.active_generation
+        self.number_start, self.number_end = self.number_range
+        backend = get_range_backend() if NATIVE_RANGE_INDEX else None
+        if backend and self.pk:
+            backend.remove([self.pk])
+        res = super(NumberingPlanRange, self).save(*args, **kwargs)
+        if backend:
+            backend.sync(self.numbering_plan_id)
+        return res
 
     def to_prefix_list(self):
-        start = ''.join(map(str, [self.numbering_plan.prefix, self.prefix, str(self.range_start)[1:]]))
-        end = ''.join(map(str, [self.numbering_plan.prefix, self.prefix, str(self.range_end)[1:]]))
+        start, end = (self.number_start, self.number_end) if self.number_start is not None else self.number_range
 
         for prefix in range_to_prefix(start, end):
             yield str(prefix)
@@ -225,3 +456,116 @@ class NumberingPlanRange(models.Model):
             str(self.range_end)[1:],
             self.range_capacity
         )
+
+
+def delete_in_batches(queryset):
+    """
+    Deletes ranges of `queryset` in batches of RFNUMPLAN_IMPORT_BATCH_SIZE, so deletion signals never load
+    the whole queryset at once
+    """
+    while True:
+        ids = list(queryset.order_by().values_list('pk', flat=True)[:IMPORT_BATCH_SIZE])
+        if not ids:
+            return
+        NumberingPlanRange.objects.filter(pk__in=ids).delete()
+
+
+@contextmanager
+def range_signals_muted():
+    """
+    Suspends `range_changed` in the current thread, for bulk paths that bump data version themselves
+    """
+    muted, _range_signals.muted = getattr(_range_signals, 'muted', False), True
+    try:
+        yield
+    finally:
+        _range_signals.muted = muted
+
+
+@receiver(post_save, sender=NumberingPlanRange)
+@receiver(post_delete, sender=NumberingPlanRange)
+def range_changed(sender, instance, **kwargs):
+    """
+    Refreshes statistics of the changed plans and bumps data version once the transaction that changed a range
+    is committed. Being a signal receiver, it catches queryset deletes and cascades (admin actions, deleting
+    an operator, region or plan) along with `save`; a queryset delete runs in a single transaction,
+    so every plan is refreshed once.
+    """
+    if getattr(_range_signals, 'muted', False):
+        return
+    if not hasattr(_range_signals, 'pending'):
+        _range_signals.pending = set()
+    _range_signals.pending.add(instance.numbering_plan_id)
+    transaction.on_commit(flush_range_changes)
+
+
+def flush_range_changes():
+    # every changed row registers a callback, only the first one of a transaction does the work
+    plan_ids, _range_signals.pending = _range_signals.pending, set()
+    if plan_ids:
+        for plan in NumberingPlan.objects.filter(pk__in=plan_ids):
+            plan.refresh_summary()
+        bump_data_version()
+
+
+class NumberingPlanStatsQuerySet(models.QuerySet):
+    def prefixes(self):
+        """
+        :return: (prefix, range count, capacity) tuples ordered by prefix
+        """
+        return self.order_by('prefix').values_list('prefix').annotate(
+            cnt=models.Sum('range_count'), capacity=models.Sum('capacity'))
+
+    def by_operator(self):
+        """
+        :return: dicts of operator id and name, range count and capacity, the largest capacity first
+        """
+        return self.order_by().values('operator_id', 'operator__name').annotate(
+            range_count=models.Sum('range_count'), capacity=models.Sum('capacity')).order_by('-capacity')
+
+    def by_region(self):
+        """
+        :return: dicts of region id and name, range count and capacity, the largest capacity first
+        """
+        return self.order_by().values('region_id', 'region__name').annotate(
+            range_count=models.Sum('range_count'), capacity=models.Sum('capacity')).order_by('-capacity')
+
+
+class NumberingPlanStats(models.Model):
+    """
+    Range counts and capacity of active ranges by plan, prefix, operator and region.
+    Rewritten by every import from the parsed rows, so summaries never aggregate the ranges table,
+    and recomputed whenever ranges are saved or deleted outside imports, see `range_changed`.
+    """
+    numbering_plan = models.ForeignKey(NumberingPlan, verbose_name=_('numbering plan'), related_name='stats')
+    prefix = models.PositiveIntegerField(_('prefix'))
+    operator = models.ForeignKey(Operator, verbose_name=_('operator'))
+    region = models.ForeignKey(Region, verbose_name=_('region'))
+    range_count = models.PositiveIntegerField(_('range count'))
+    capacity = models.BigIntegerField(_('capacity'))
+
+    objects = NumberingPlanStatsQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('numbering plan statistics')
+        verbose_name_plural = _('numbering plan statistics')
+        ordering = ['numbering_plan_id', 'prefix']
+
+    def __str__(self):
+        return '%s %s' % (self.numbering_plan.name, self.prefix)
+
+
+class DataVersion(models.Model):
+    """
+    Single row counter of stored plans data changes, see `rfnumplan.cache.get_data_version`
+    """
+    ROW = 1
+
+    version = models.BigIntegerField(_('version'), default=0)
+
+    class Meta:
+        verbose_name = _('data version')
+        verbose_name_plural = _('data versions')
+
+    def __str__(self):
+        return str(self.version)
@@ -0,0 +1,74 @@
+import re
+
+import phonenumbers
+from django.utils.translation import ugettext_lazy as _
+
+# separators people put into numbers: spaces, dashes, dots, brackets
+SEPARATORS = re.compile(r'[\s\-.()‐-―]')
+DIGITS = re.compile(r'[0-9]+')
+
+# first digit of russian ABC/DEF codes, the rest (+76, +77) belongs to Kazakhstan
+RU_CODE_FIRST_DIGITS = frozenset('3489')
+
+
+def fast_normalize(phone_number: str):
+    """
+    Normalizes common RU number shapes with plain string operations:
+    +7XXXXXXXXXX, 8XXXXXXXXXX, 7XXXXXXXXXX and bare 10-digit XXXXXXXXXX, separators allowed.
+    :return: E.164 digits without `+` or None if the shape is ambiguous and needs phonenumbers
+    """
+    number = SEPARATORS.sub('', phone_number)
+    plus = number.startswith('+')
+    if plus:
+        number = number[1:]
+    if not DIGITS.fullmatch(number):
+        return None
+
+    if len(number) == 11 and (number[0] == '7' or number[0] == '8' and not plus):
+        national = number[1:]
+    elif len(number) == 10 and not plus:
+        national = number
+    else:
+        return None
+
+    if national[0] not in RU_CODE_FIRST_DIGITS:
+        return None
+    return '7' + national
+
+
+def normalize(phone_number: str) -> str:
+    """
+    Returns E.164 digits of `phone_number` without leading `+`.
+    Well-formed RU numbers skip phonenumbers entirely; whether such a number exists is decided
+    by the numbering plan lookup, not by libphonenumber metadata.
+    :raises ValueError: if number is not valid
+    """
+    res = fast_normalize(phone_number)
+    if res:
+        return res
+
+    try:
+        number = phonenumbers.parse(phone_number, region='RU')
+    except phonenumbers.NumberParseException:
+        number = None
+    if number is None or not phonenumbers.is_valid_number(number):
+        raise ValueError(_('Wrong number %s') % phone_number)
+
+    return phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164).lstrip('+')
+
+
+def normalize_many(phone_numbers) -> list:
+    """
+    Batch variant of `normalize`: every distinct input is normalized once
+    :return: list of E.164 digits or None for invalid numbers, in the input order
+    """
+    cache = {}
+    res = []
+    for phone_number in phone_numbers:
+        if phone_number not in cache:
+            try:
+                cache[phone_number] = normalize(phone_number)
+            except ValueError:
+                cache[phone_number] = None
+        res.append(cache[phone_number])
+    return res
@@ -0,0 +1,124 @@
+import json
+
+from django.core.paginator import Paginator, EmptyPage
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
+
+# keyset of ranges listings, matches `NumberingPlanRange.Meta.ordering` plus pk as a tie-breaker
+RANGE_KEYS = ('numbering_plan_id', 'prefix', 'range_start', 'pk')
+
+
+def row_key(row, keys) -> tuple:
+    if isinstance(row, dict):
+        return tuple(row[key] for key in keys)
+    return tuple(getattr(row, key) for key in keys)
+
+
+def format_key(key: tuple) -> str:
+    """
+    Cursor of a row for `--after`: format_key((1, 900, 15550000, 42)) -> '1,900,15550000,42'
+    """
+    return ','.join(map(str, key))
+
+
+def parse_key(value: str, keys=RANGE_KEYS) -> tuple:
+    """
+    Inverse of `format_key`
+    :raises ValueError: if `value` is not a comma-separated list of len(keys) integers
+    """
+    key = tuple(int(part) for part in value.split(','))
+    if len(key) != len(keys):
+        raise ValueError('%s values expected, got %s' % (len(keys), len(key)))
+    return key
+
+
+def seek_filter(keys, values) -> Q:
+    """
+    Rows strictly after `values` in `keys` order:
+    (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...
+    """
+    res = Q()
+    for i, key in enumerate(keys):
+        condition = Q(**{'%s__gt' % key: values[i]})
+        for prev_key, prev_value in zip(keys[:i], values[:i]):
+            condition &= Q(**{prev_key: prev_value})
+        res |= condition
+    return res
+
+
+def keyset_pages(queryset, size: int, keys=RANGE_KEYS, after=None) -> iter:
+    """
+    Yields lists of at most `size` rows ordered by `keys`. Every page is fetched with a seek condition
+    on the last row of the previous one, so deep pages cost as much as the first one, unlike OFFSET.
+    :param queryset: model or `values()` queryset; `values()` must include `keys`
+    :param after: key of the row to start after
+    """
+    queryset = queryset.order_by(*keys)
+    while True:
+        page = list((queryset.filter(seek_filter(keys, after)) if after else queryset)[:size])
+        if page:
+            yield page
+        if len(page) < size:
+            return
+        after = row_key(page[-1], keys)
+
+
+def keyset_page(queryset, number: int, size: int, keys=RANGE_KEYS, after=None) -> list:
+    """
+    Page `number` (1-based) of `keyset_pages` starting after `after` key.
+    The key of the last row before the page is found with a single key-only query, then the page is seeked from it.
+    """
+    if number > 1:
+        offset = (number - 1) * size - 1
+        keysets = queryset.order_by(*keys).values_list(*keys)
+        if after:
+            keysets = keysets.filter(seek_filter(keys, after))
+        previous = list(keysets[offset:offset + 1])
+        if not previous:
+            return []
+        after = previous[0]
+    return next(keyset_pages(queryset, size, keys=keys, after=after), [])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that does not count the whole table on PostgreSQL: planner estimate is used there,
+    other databases count exactly. The estimate may fall short of the real count, so pages past it
+    are served as long as they have rows.
+    """
+
+    @cached_property
+    def estimated(self) -> bool:
+        return connections[self.object_list.db].vendor == 'postgresql'
+
+    @cached_property
+    def count(self):
+        if not self.estimated:
+            return super(EstimatedCountPaginator, self).count
+        sql, params = self.object_list.query.sql_with_params()
+        with connections[self.object_list.db].cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def validate_number(self, number):
+        try:
+            return super(EstimatedCountPaginator, self).validate_number(number)
+        except EmptyPage:
+            if not self.estimated or int(number) < 1:
+                raise
+            return int(number)
+
+    def page(self, number):
+        if not self.estimated:
+            return super(EstimatedCountPaginator, self).page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page])
+        if not object_list and number > 1:
+            raise EmptyPage(_('That page contains no results'))
+        return self._get_page(object_list, number, self)
@@ -0,0 +1,235 @@
+import bisect
+import csv
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from .snapshot import pack_strings, StringTable
+from .settings import INDEX_CHECK_INTERVAL, PORTABILITY_PATH
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = b'RFMP'
+FORMAT_VERSION = 1
+
+# magic, format version, reserved, numbers count, operators count
+HEADER = struct.Struct('<4sHHQQ')
+
+# operator code of delta rows that return a number to its range owner
+REMOVED = 0xFFFF
+
+
+def iter_registry(lines) -> iter:
+    """
+    Streams (number, operator) pairs from ported numbers registry csv (`,` or `;` separated).
+    Columns are taken from `Number` and `OwnerId` header fields, or are the first two columns if there is no header.
+    Numbers are 10-digit national or 11-digit with leading 7/8, rows with other numbers are skipped.
+    Empty operator means the number was returned to its range owner (in delta files).
+    """
+    lines = iter(lines)
+    first = next(lines, '')
+    delimiter = ',' if first.count(',') >= first.count(';') else ';'
+
+    number_col, operator_col = 0, 1
+    header = next(csv.reader([first], delimiter=delimiter), [])
+    if header and not header[0].strip().isdigit():
+        names = [name.strip().lower() for name in header]
+        number_col = names.index('number') if 'number' in names else 0
+        operator_col = names.index('ownerid') if 'ownerid' in names else 1
+    else:
+        lines = itertools.chain([first], lines)
+
+    for row in csv.reader(lines, delimiter=delimiter):
+        if len(row) <= number_col:
+            continue
+        number = row[number_col].strip()
+        if len(number) == 11 and number[0] in '78':
+            number = number[1:]
+        if len(number) != 10 or not number.isdigit():
+            continue
+        yield int('7' + number), row[operator_col].strip() if len(row) > operator_col else ''
+
+
+def padding(size: int) -> int:
+    return -size % 8
+
+
+class PortabilityOverlay(object):
+    """
+    Ported numbers -> current operator. Numbers are a sorted int64 column, operators are dictionary-encoded
+    into a parallel uint16 column, which is 10 bytes per ported number.
+    Overlays loaded from file are memoryviews over a shared mmap, like `rfnumplan.snapshot.Snapshot`.
+    """
+
+    def __init__(self, numbers, codes, operators):
+        self.numbers = numbers
+        self.codes = codes
+        self.operators = operators
+        self.path = self.file_id = None
+
+    def __len__(self):
+        return len(self.numbers)
+
+    @classmethod
+    def build(cls, rows, base=None):
+        """
+        :param rows: iterable of (number, operator), see `iter_registry`; the last row of a number wins
+        :param base: overlay the rows are applied to as a delta
+        """
+        operators = base.operator_names() if base else []
+        operator_codes = {name: i for i, name in enumerate(operators)}
+        numbers, codes = array('q'), array('H')
+        if base:
+            numbers.frombytes(bytes(base.numbers))
+            codes.frombytes(bytes(base.codes))
+
+        for number, operator in rows:
+            if not operator:
+                code = REMOVED
+            elif operator in operator_codes:
+                code = operator_codes[operator]
+            else:
+                code = operator_codes[operator] = len(operators)
+                operators.append(operator)
+            numbers.append(number)
+            codes.append(code)
+
+        if len(operators) >= REMOVED:
+            raise ValueError('too many operators: %s' % len(operators))
+        return cls(*cls.compact(numbers, codes), operators)
+
+    @staticmethod
+    def compact(numbers: array, codes: array) -> tuple:
+        """
+        Sorts columns by number keeping the last code of every number, then drops returned numbers
+        """
+        if np is not None:
+            n, c = np.frombuffer(numbers, dtype=np.int64), np.frombuffer(codes, dtype=np.uint16)
+            order = np.argsort(n, kind='stable')
+            n, c = n[order], c[order]
+            keep = np.ones(len(n), dtype=bool)
+            keep[:-1] = n[:-1] != n[1:]
+            keep &= c != REMOVED
+            return array('q', n[keep].tobytes()), array('H', c[keep].tobytes())
+
+        order = sorted(range(len(numbers)), key=numbers.__getitem__)
+        res_numbers, res_codes = array('q'), array('H')
+        for k, i in enumerate(order):
+            if k + 1 < len(order) and numbers[order[k + 1]] == numbers[i] or codes[i] == REMOVED:
+                continue
+            res_numbers.append(numbers[i])
+            res_codes.append(codes[i])
+        return res_numbers, res_codes
+
+    def operator_names(self) -> list:
+        return [self.operators[i] for i in range(len(self.operators))]
+
+    def lookup(self, number: int):
+        """
+        :return: operator of ported `number` or None
+        """
+        i = bisect.bisect_left(self.numbers, number)
+        if i < len(self.numbers) and self.numbers[i] == number:
+            return self.operators[self.codes[i]]
+        return None
+
+    def lookup_many(self, numbers: list) -> list:
+        """
+        :param numbers: sorted list of numbers
+        :return: list of operators or None in the order of `numbers`
+        """
+        if np is None or not numbers:
+            return [self.lookup(number) for number in numbers]
+        column = np.frombuffer(self.numbers, dtype=np.int64)
+        positions = np.searchsorted(column, np.array(numbers, dtype=np.int64)).tolist()
+        size = len(column)
+        return [self.operators[self.codes[i]] if i < size and self.numbers[i] == number else None
+                for number, i in zip(numbers, positions)]
+
+    def save(self, path: str):
+        """
+        Writes overlay into `path` atomically: header, int64 numbers, uint16 codes padded to 8 bytes,
+        operators string table
+        """
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(self.numbers), len(self.operators)))
+            f.write(bytes(self.numbers))
+            f.write(bytes(self.codes))
+            f.write(bytes(padding(2 * len(self.codes))))
+            f.write(pack_strings(self.operator_names()))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, fmt, _reserved, count, n_operators = HEADER.unpack_from(mapped)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError('%s is not a rfnumplan portability overlay of format %s' % (path, FORMAT_VERSION))
+
+        view = memoryview(mapped)
+        offset = HEADER.size
+        numbers = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        codes = view[offset:offset + 2 * count].cast('H')
+        offset += 2 * count + padding(2 * count)
+        offsets = view[offset:offset + 4 * (n_operators + 1)].cast('I')
+        offset += 4 * (n_operators + 1)
+        operators = StringTable(offsets, view[offset:offset + offsets[-1]])
+
+        overlay = cls(numbers, codes, operators)
+        overlay.path, overlay.file_id = path, (stat.st_ino, stat.st_mtime_ns)
+        return overlay
+
+
+def import_registry(lines, path: str = None, delta=False) -> PortabilityOverlay:
+    """
+    Builds overlay from registry `lines` and saves it into `path` (RFNUMPLAN_PORTABILITY_PATH by default).
+    :param delta: apply `lines` on top of the overlay stored in `path` instead of replacing it
+    """
+    path = path or PORTABILITY_PATH
+    base = PortabilityOverlay.load(path) if delta and os.path.exists(path) else None
+    overlay = PortabilityOverlay.build(iter_registry(lines), base=base)
+    overlay.save(path)
+    return overlay
+
+
+_overlay = None
+_checked_path = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def get_overlay(path: str = None) -> PortabilityOverlay:
+    """
+    Returns process-wide overlay of `path` (RFNUMPLAN_PORTABILITY_PATH by default) or None if there is none.
+    File is re-stat'ed at most once per RFNUMPLAN_INDEX_CHECK_INTERVAL seconds and remapped when replaced.
+    """
+    global _overlay, _checked_path, _checked_at
+    path = path or PORTABILITY_PATH
+    if not path:
+        return None
+
+    if _checked_path == path and time.monotonic() - _checked_at < INDEX_CHECK_INTERVAL:
+        return _overlay
+
+    with _lock:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            _overlay = None
+        else:
+            if _overlay is None or _overlay.path != path or _overlay.file_id != (stat.st_ino, stat.st_mtime_ns):
+                _overlay = PortabilityOverlay.load(path)
+        _checked_path, _checked_at = path, time.monotonic()
+        return _overlay
@@ -0,0 +1,142 @@
+import time
+
+from django.db import connection, transaction
+
+from .settings import INDEX_CHECK_INTERVAL
+
+
+class RangeBackend(object):
+    """
+    Database-native interval index over `NumberingPlanRange` (number_start, number_end) kept in a side table.
+    The table is created and backfilled by `create_schema` (`rfnumplan --create-range-index`), never by lookups;
+    until it exists lookups use the plain index. Imports keep it in sync with `sync`.
+    """
+    table = None
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.ready = False
+        self.checked_at = None
+
+    @property
+    def ranges_table(self) -> str:
+        from rfnumplan.models import NumberingPlanRange
+        return NumberingPlanRange._meta.db_table
+
+    def execute(self, statements, params=None):
+        with self.connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql % {'table': self.table, 'ranges': self.ranges_table}, params)
+
+    def is_ready(self) -> bool:
+        """
+        True if the side table exists; a missing table is looked up again at most once per
+        RFNUMPLAN_INDEX_CHECK_INTERVAL seconds
+        """
+        if not self.ready and (self.checked_at is None or time.monotonic() - self.checked_at >= INDEX_CHECK_INTERVAL):
+            self.ready = self.table in self.connection.introspection.table_names()
+            self.checked_at = time.monotonic()
+        return self.ready
+
+    def create_schema(self):
+        """
+        Creates the side table and fills it from stored ranges, e.g. PostgreSQL needs a role allowed
+        to create btree_gist extension for it
+        """
+        if self.table not in self.connection.introspection.table_names():
+            with transaction.atomic(using=self.connection.alias):
+                self.execute(self.schema)
+                self.execute(self.backfill)
+        self.ready = True
+
+    def sync(self, plan_id: int):
+        """
+        Adds ranges of plan missing from the side table and drops rows of deleted ranges
+        """
+        if self.is_ready():
+            self.execute(self.insert_missing, [plan_id])
+            self.execute(self.delete_orphans)
+
+    def remove(self, ids: list):
+        """
+        Drops side rows of ranges whose bounds are about to change
+        """
+        if ids and self.is_ready():
+            sql = 'DELETE FROM %s WHERE %s IN (%s)' % (self.table, self.id_column, ', '.join(['%s'] * len(ids)))
+            with self.connection.cursor() as cursor:
+                cursor.execute(sql, list(ids))
+
+    def containing(self, number: int) -> tuple:
+        """
+        :return: (where clause, params) for `QuerySet.extra` keeping only ranges that may contain `number`
+                 or None if the side table is not created
+        """
+        if not self.is_ready():
+            return None
+        sql, params = self.lookup
+        where = '%s.id IN (%s)' % (self.connection.ops.quote_name(self.ranges_table), sql % {'table': self.table})
+        return where, [number] * params
+
+
+class PostgresRangeBackend(RangeBackend):
+    """
+    int8range with GiST index; ranges of one plan generation must not overlap (exclusion constraint,
+    needs btree_gist extension). Rows of deleted ranges go away with ON DELETE CASCADE.
+    """
+    table = 'rfnumplan_range_span'
+    id_column = 'range_id'
+    schema = [
+        'CREATE EXTENSION IF NOT EXISTS btree_gist',
+        'CREATE TABLE %(table)s ('
+        ' range_id integer PRIMARY KEY REFERENCES %(ranges)s (id) ON DELETE CASCADE,'
+        ' numbering_plan_id integer NOT NULL,'
+        ' generation integer NOT NULL,'
+        ' span int8range NOT NULL,'
+        ' EXCLUDE USING gist (numbering_plan_id WITH =, generation WITH =, span WITH &&))',
+        'CREATE INDEX %(table)s_span ON %(table)s USING gist (span)',
+    ]
+    select = ('SELECT r.id, r.numbering_plan_id, r.generation, int8range(r.number_start, r.number_end, \'[]\') '
+              'FROM %(ranges)s r LEFT JOIN %(table)s s ON s.range_id = r.id '
+              'WHERE s.range_id IS NULL AND r.number_start IS NOT NULL')
+    backfill = ['INSERT INTO %(table)s (range_id, numbering_plan_id, generation, span) ' + select]
+    insert_missing = ['INSERT INTO %(table)s (range_id, numbering_plan_id, generation, span) ' + select +
+                      ' AND r.numbering_plan_id = %%s']
+    delete_orphans = []
+    lookup = ('SELECT range_id FROM %(table)s WHERE span @> %%s::int8', 1)
+
+
+class SqliteRangeBackend(RangeBackend):
+    """
+    1-D R*Tree virtual table. R*Tree stores float32 bounds rounded outwards, so it only narrows
+    candidates down; exact bounds are checked against the ranges table.
+    """
+    table = 'rfnumplan_range_rtree'
+    id_column = 'id'
+    schema = ['CREATE VIRTUAL TABLE %(table)s USING rtree(id, number_start, number_end)']
+    select = ('SELECT r.id, r.number_start, r.number_end '
+              'FROM %(ranges)s r LEFT JOIN %(table)s s ON s.id = r.id '
+              'WHERE s.id IS NULL AND r.number_start IS NOT NULL')
+    backfill = ['INSERT INTO %(table)s (id, number_start, number_end) ' + select]
+    insert_missing = ['INSERT INTO %(table)s (id, number_start, number_end) ' + select +
+                      ' AND r.numbering_plan_id = %%s']
+    delete_orphans = ['DELETE FROM %(table)s WHERE id NOT IN (SELECT id FROM %(ranges)s)']
+    lookup = ('SELECT id FROM %(table)s WHERE number_start <= %%s AND number_end >= %%s', 2)
+
+
+BACKENDS = {
+    'postgresql': PostgresRangeBackend,
+    'sqlite': SqliteRangeBackend,
+}
+
+_backends = {}
+
+
+def get_range_backend() -> RangeBackend:
+    """
+    :return: native range backend of the default database or None if its vendor is not supported
+    """
+    key = (connection.alias, connection.settings_dict['NAME'])
+    if key not in _backends:
+        backend_class = BACKENDS.get(connection.vendor)
+        _backends[key] = backend_class(connection) if backend_class else None
+    return _backends[key]
@@ -1,4 +1,27 @@
+import os
+import tempfile
+
 from django.conf import settings
 
 MAX_PREFIX_LENGTH = getattr(settings, 'RFNUMPLAN_MAX_PREFIX_LENGTH', 5)
 PAGE_SIZE = getattr(settings, 'RFNUMPLAN_PAGE_SIZE', 20)
+INDEX_CHECK_INTERVAL = getattr(settings, 'RFNUMPLAN_INDEX_CHECK_INTERVAL', 30)
+MAX_RANGE_CAPACITY = getattr(settings, 'RFNUMPLAN_MAX_RANGE_CAPACITY', 10 ** 7)
+FIND_LIMIT = getattr(settings, 'RFNUMPLAN_FIND_LIMIT', 10)
+IMPORT_BATCH_SIZE = getattr(settings, 'RFNUMPLAN_IMPORT_BATCH_SIZE', 2000)
+GC_IN_BACKGROUND = getattr(settings, 'RFNUMPLAN_GC_IN_BACKGROUND', True)
+CACHE_DIR = getattr(settings, 'RFNUMPLAN_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'rfnumplan'))
+FETCH_TIMEOUT = getattr(settings, 'RFNUMPLAN_FETCH_TIMEOUT', 60)
+SNAPSHOT_PATH = getattr(settings, 'RFNUMPLAN_SNAPSHOT_PATH', None)
+LOOKUP_CACHE_SIZE = getattr(settings, 'RFNUMPLAN_LOOKUP_CACHE_SIZE', 100000)
+LOOKUP_CACHE_BLOCK_SIZE = getattr(settings, 'RFNUMPLAN_LOOKUP_CACHE_BLOCK_SIZE', 10000)
+LOOKUP_CACHE_CHECK_INTERVAL = getattr(settings, 'RFNUMPLAN_LOOKUP_CACHE_CHECK_INTERVAL', 5)
+BULK_CHUNK_SIZE = getattr(settings, 'RFNUMPLAN_BULK_CHUNK_SIZE', 10000)
+LOOKUP_MAX_BATCH = getattr(settings, 'RFNUMPLAN_LOOKUP_MAX_BATCH', 1000)
+LOOKUP_MAX_AGE = getattr(settings, 'RFNUMPLAN_LOOKUP_MAX_AGE', 300)
+METRICS_SINKS = getattr(settings, 'RFNUMPLAN_METRICS_SINKS', [])
+METRICS_PREFIX = getattr(settings, 'RFNUMPLAN_METRICS_PREFIX', 'rfnumplan.')
+METRICS_STATSD_ADDRESS = getattr(settings, 'RFNUMPLAN_METRICS_STATSD_ADDRESS', ('127.0.0.1', 8125))
+NATIVE_RANGE_INDEX = getattr(settings, 'RFNUMPLAN_NATIVE_RANGE_INDEX', False)
+PORTABILITY_PATH = getattr(settings, 'RFNUMPLAN_PORTABILITY_PATH', None)
+LIST_CHUNK_SIZE = getattr(settings, 'RFNUMPLAN_LIST_CHUNK_SIZE', 1000)
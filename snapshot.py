@@ -0,0 +1,173 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+from .settings import INDEX_CHECK_INTERVAL, SNAPSHOT_PATH
+
+MAGIC = b'RFNP'
+FORMAT_VERSION = 1
+
+# magic, format version, reserved, ranges count, operators count, regions count, data version
+HEADER = struct.Struct('<4sHHQIIQ')
+
+SnapshotRecord = namedtuple('SnapshotRecord', ['range_id', 'number_start', 'number_end', 'operator', 'region'])
+
+
+def version_hash(version) -> int:
+    """
+    Packs arbitrary plans version (see `RangeIndex.current_version`) into an unsigned 64-bit integer
+    """
+    return int.from_bytes(hashlib.sha1(repr(version).encode('utf-8')).digest()[:8], 'little')
+
+
+def pack_strings(strings: list) -> bytes:
+    """
+    String table: (count + 1) uint32 offsets followed by utf-8 blob
+    """
+    blobs = [s.encode('utf-8') for s in strings]
+    offsets = array('I', [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    return offsets.tobytes() + b''.join(blobs)
+
+
+def write_snapshot(path: str, index=None) -> int:
+    """
+    Writes range index into a binary snapshot:
+    header, int64 columns (starts, ends, max_ends, range ids), int32 columns (operator and region string ids),
+    operator and region string tables.
+    File is replaced atomically, so loaders that have mapped the previous one keep using it until reload.
+    :param index: `RangeIndex`, built from the database if not given
+    :return: number of ranges written
+    """
+    from rfnumplan.index import RangeIndex
+    index = index or RangeIndex.build()
+
+    operator_names = sorted(index.operators.values(), key=lambda o: o.pk)
+    region_names = sorted(index.regions.values(), key=lambda r: r.pk)
+    operator_codes = {o.pk: i for i, o in enumerate(operator_names)}
+    region_codes = {r.pk: i for i, r in enumerate(region_names)}
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(index), len(operator_names), len(region_names),
+                            version_hash(index.version)))
+        for column in (index.starts, index.ends, index.max_ends, index.ids):
+            f.write(array('q', column).tobytes())
+        f.write(array('i', (operator_codes[pk] for pk in index.operator_ids)).tobytes())
+        f.write(array('i', (region_codes[pk] for pk in index.region_ids)).tobytes())
+        f.write(pack_strings([o.name for o in operator_names]))
+        f.write(pack_strings([r.name for r in region_names]))
+    os.replace(tmp_path, path)
+    return len(index)
+
+
+class StringTable(object):
+    """
+    Lazily decoded view of a packed string table, see `pack_strings`
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self.cache = {}
+
+    def __getitem__(self, i: int) -> str:
+        if i not in self.cache:
+            self.cache[i] = bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+        return self.cache[i]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class Snapshot(object):
+    """
+    Read-only view of a snapshot file. Columns are memoryviews over a shared mmap,
+    so every process that loads the same file shares its pages and nothing is copied.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+
+        magic, fmt, _reserved, count, n_operators, n_regions, self.version = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError('%s is not a rfnumplan snapshot of format %s' % (path, FORMAT_VERSION))
+
+        view = memoryview(self.mmap)
+        offset = HEADER.size
+
+        def column(fmt, size, n):
+            nonlocal offset
+            res = view[offset:offset + size * n].cast(fmt)
+            offset += size * n
+            return res
+
+        self.starts, self.ends, self.max_ends, self.ids = (column('q', 8, count) for _i in range(4))
+        self.operator_ids, self.region_ids = column('i', 4, count), column('i', 4, count)
+        self.operators = self.read_strings(column('I', 4, n_operators + 1), view, offset)
+        offset += len(self.operators.blob)
+        self.regions = self.read_strings(column('I', 4, n_regions + 1), view, offset)
+
+    @staticmethod
+    def read_strings(offsets, view, offset):
+        return StringTable(offsets, view[offset:offset + offsets[-1]])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, number: int) -> list:
+        """
+        :return: `SnapshotRecord` list of ranges containing `number`
+        """
+        res = []
+        i = bisect.bisect_right(self.starts, number) - 1
+        while i >= 0 and self.max_ends[i] >= number:
+            if self.ends[i] >= number:
+                res.append(SnapshotRecord(self.ids[i], self.starts[i], self.ends[i],
+                                          self.operators[self.operator_ids[i]], self.regions[self.region_ids[i]]))
+            i -= 1
+        return res[::-1]
+
+
+_snapshot = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def get_snapshot(path: str = None) -> Snapshot:
+    """
+    Returns process-wide `Snapshot` of `path` (RFNUMPLAN_SNAPSHOT_PATH by default).
+    File is re-stat'ed at most once per RFNUMPLAN_INDEX_CHECK_INTERVAL seconds and remapped
+    when it was replaced with a snapshot of another data version.
+    """
+    global _snapshot, _checked_at
+    path = path or SNAPSHOT_PATH
+
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.path == path and time.monotonic() - _checked_at < INDEX_CHECK_INTERVAL:
+        return snapshot
+
+    with _lock:
+        if _snapshot is None or _snapshot.path != path:
+            _snapshot = Snapshot(path)
+        else:
+            stat = os.stat(path)
+            if (stat.st_ino, stat.st_mtime_ns) != _snapshot.file_id:
+                fresh = Snapshot(path)
+                if fresh.version != _snapshot.version:
+                    _snapshot = fresh
+                else:
+                    _snapshot.file_id = fresh.file_id
+        _checked_at = time.monotonic()
+        return _snapshot
@@ -0,0 +1,59 @@
+import random
+
+HEADER = 'АВС/ DEF;От;До;Емкость;Оператор;Регион'
+
+
+def generate_plan_rows(count: int, operators=50, regions=85, codes=range(900, 1000), seed=0) -> iter:
+    """
+    Yields realistic rossvyaz-like bundles (see `utils.FIELDS`): `count` sorted non-overlapping ranges
+    spread over `codes`, contiguous runs interleaved with gaps, with skewed operator and region distribution.
+    """
+    rnd = random.Random(seed)
+    operator_names = ['ООО "Оператор связи %s"' % i for i in range(operators)]
+    region_names = ['Регион %s' % i for i in range(regions)]
+    # a few big operators own most of the ranges
+    operator_weights = [1.0 / (i + 1) for i in range(operators)]
+
+    codes = list(codes)
+    per_code, extra = divmod(count, len(codes))
+    for n, code in enumerate(codes):
+        k = per_code + (1 if n < extra else 0)
+        if not k:
+            continue
+        cuts = sorted(rnd.sample(range(1, 10 ** 7), k - 1)) if k > 1 else []
+        bounds = [0, *cuts, 10 ** 7]
+        for start, next_start in zip(bounds, bounds[1:]):
+            end = next_start - 1
+            if rnd.random() < 0.1 and end > start:
+                end = rnd.randint(start, end)
+            yield {
+                'prefix': str(code),
+                'range_start': '%07d' % start,
+                'range_end': '%07d' % end,
+                'range_capacity': str(end - start + 1),
+                'operator': rnd.choices(operator_names, weights=operator_weights)[0],
+                'region': rnd.choice(region_names),
+            }
+
+
+def write_plan_csv(path: str, count: int, **kwargs) -> int:
+    """
+    Writes `generate_plan_rows` into cp1251 `;`-separated csv with rossvyaz header
+    :return: number of ranges written
+    """
+    written = 0
+    with open(path, 'w', encoding='cp1251', newline='') as f:
+        f.write(HEADER + '\r\n')
+        for bundle in generate_plan_rows(count, **kwargs):
+            f.write('%(prefix)s;%(range_start)s;%(range_end)s;%(range_capacity)s;%(operator)s;%(region)s\r\n' % bundle)
+            written += 1
+    return written
+
+
+def random_numbers(count: int, codes=range(900, 1000), seed=0) -> list:
+    """
+    Random `+7XXXXXXXXXX` numbers within `codes`
+    """
+    rnd = random.Random(seed)
+    codes = list(codes)
+    return ['+7%s%07d' % (rnd.choice(codes), rnd.randrange(10 ** 7)) for _i in range(count)]
@@ -1,3 +1,649 @@
+import hashlib
+import io
+import os
+import pathlib
+import random
+import re
+import shutil
+import tempfile
+import threading
+from array import array
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+import phonenumbers
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 
-# Create your tests here.
+from rfnumplan.dimensions import operator_cache, region_cache
+from rfnumplan.fetch import PlanFetcher
+from rfnumplan.index import RangeIndex, FOUND, NOT_FOUND, INVALID, RANGES
+from rfnumplan.models import NumberingPlan, NumberingPlanRange, ImportStats, Operator, Region
+from rfnumplan.normalize import fast_normalize, normalize
+from rfnumplan.pagination import keyset_page, keyset_pages, seek_filter, format_key, parse_key, row_key, RANGE_KEYS
+from rfnumplan.portability import PortabilityOverlay, REMOVED
+from rfnumplan.snapshot import Snapshot, write_snapshot, version_hash
+from rfnumplan.synthetic import write_plan_csv, generate_plan_rows
+from rfnumplan.trie import PrefixTrie
+from rfnumplan.utils import range_to_prefix, coalesce_ranges, collapse_prefixes, absolute_number
+
+
+def baseline_range_to_prefix(a, b):
+    """
+    Recursive `range_to_prefix` the iterative one replaced, kept as the reference output
+    """
+    def inner(aa, bb, p):
+        if p == 1:
+            if a <= aa <= b:
+                yield aa
+            return
+
+        for d in range(aa, bb + 1, p):
+            if a <= d and d + p - 1 <= b:
+                yield d // p
+            elif not (bb < a or aa > b):
+                for i in range(10):
+                    yield from inner(d + i * p // 10, d + (i + 1) * p // 10 - 1, p // 10)
+
+    a, b = int(a), int(b)
+    p = 10 ** (max(len(str(x)) for x in (a, b)) - 1)
+    yield from inner(a // p * p, b // p * p + p - 1, p)
+
+
+def expand_prefix(prefix, length: int) -> range:
+    """
+    Numbers of `length` digits starting with `prefix`
+    """
+    scale = 10 ** (length - len(str(prefix)))
+    return range(int(prefix) * scale, (int(prefix) + 1) * scale)
+
+
+class RangeToPrefixTestCase(TestCase):
+    def test_example(self):
+        self.assertEqual(list(range_to_prefix(79005550000, 79005555549)),
+                         [79005550, 79005551, 79005552, 79005553, 79005554,
+                          790055550, 790055551, 790055552, 790055553, 790055554,
+                          7900555550, 7900555551, 7900555552, 7900555553, 7900555554])
+        self.assertEqual(list(range_to_prefix(79001000000, 79002999999)), [79001, 79002])
+
+    def test_matches_baseline(self):
+        rnd = random.Random(0)
+        for _ in range(20000):
+            a = rnd.randrange(7 * 10 ** 10, 8 * 10 ** 10)
+            b = min(a + rnd.randrange(10 ** rnd.randrange(1, 8)), 10 ** 11 - 1)
+            self.assertEqual(list(range_to_prefix(a, b)), list(baseline_range_to_prefix(a, b)), (a, b))
+
+    def test_exact_cover(self):
+        rnd = random.Random(1)
+        for _ in range(2000):
+            a = rnd.randrange(1000, 10000)
+            b = rnd.randrange(a, 10000)
+            covered = [n for prefix in range_to_prefix(a, b) for n in expand_prefix(prefix, 4)]
+            self.assertEqual(covered, list(range(a, b + 1)), (a, b))
+
+
+class CoalesceRangesTestCase(TestCase):
+    def test_example(self):
+        ranges = [('a', 1, 5), ('a', 6, 9), ('a', 8, 12), ('a', 14, 15), ('b', 16, 20), ('a', 21, 22)]
+        self.assertEqual(list(coalesce_ranges(ranges)),
+                         [('a', 1, 12), ('a', 14, 15), ('b', 16, 20), ('a', 21, 22)])
+
+    def test_same_numbers_per_key(self):
+        rnd = random.Random(2)
+        for _ in range(500):
+            ranges = []
+            for _ in range(rnd.randrange(1, 20)):
+                start = rnd.randrange(0, 200)
+                ranges.append((rnd.choice('ab'), start, start + rnd.randrange(0, 20)))
+            ranges.sort()
+
+            merged = list(coalesce_ranges(ranges))
+            for key in 'ab':
+                expected = {n for k, start, end in ranges if k == key for n in range(start, end + 1)}
+                actual = [n for k, start, end in merged if k == key for n in range(start, end + 1)]
+                self.assertEqual(sorted(actual), sorted(expected))
+                self.assertEqual(len(actual), len(set(actual)), 'merged ranges overlap')
+            for (key, _start, end), (next_key, next_start, _end) in zip(merged, merged[1:]):
+                if key == next_key:
+                    self.assertGreater(next_start, end + 1, 'contiguous ranges left unmerged')
+
+
+class CollapsePrefixesTestCase(TestCase):
+    def test_example(self):
+        self.assertEqual(collapse_prefixes(['790', '791', '792', '793', '794', '795', '796', '797', '798', '799']),
+                         ['79'])
+        self.assertEqual(collapse_prefixes(['790', '791']), ['790', '791'])
+
+    def test_pieces_collapse_into_range_cover(self):
+        rnd = random.Random(3)
+        for _ in range(500):
+            a = rnd.randrange(10000, 100000)
+            b = rnd.randrange(a, min(a + 5000, 100000))
+            cuts = sorted(rnd.sample(range(a + 1, b + 1), min(b - a, rnd.randrange(0, 10))))
+            bounds = [a, *cuts, b + 1]
+            prefixes = [p for start, end in zip(bounds, bounds[1:]) for p in range_to_prefix(start, end - 1)]
+
+            collapsed = collapse_prefixes(prefixes)
+            self.assertEqual(collapsed, sorted(map(str, range_to_prefix(a, b))), (a, b, cuts))
+            covered = [n for prefix in collapsed for n in expand_prefix(prefix, 5)]
+            self.assertEqual(sorted(covered), list(range(a, b + 1)), (a, b, cuts))
+
+
+class NormalizeTestCase(TestCase):
+    # {n} is a random 10-digit national number, {a}-{d} are its 3-3-2-2 digit groups
+    shapes = [
+        '+7{n}', '8{n}', '7{n}', '{n}', '7 {n}', '+7 ({a}) {b}-{c}-{d}', '8-{a}-{b}-{c}{d}', '+7.{a}.{b}.{c}.{d}',
+        '8 ({a}) {b} {c} {d}', '+8{n}', '+7{n}1',
+    ]
+
+    @staticmethod
+    def parse(phone_number: str):
+        """
+        :return: (E.164 digits, is valid) by phonenumbers, (None, False) if it can not parse the number
+        """
+        try:
+            number = phonenumbers.parse(phone_number, region='RU')
+        except phonenumbers.NumberParseException:
+            return None, False
+        e164 = phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164).lstrip('+')
+        return e164, phonenumbers.is_valid_number(number)
+
+    def test_matches_phonenumbers(self):
+        rnd = random.Random(0)
+        for _ in range(20000):
+            n = ''.join(rnd.choice('0123456789') for _ in range(10))
+            phone_number = rnd.choice(self.shapes).format(n=n, a=n[:3], b=n[3:6], c=n[6:8], d=n[8:])
+            e164, valid = self.parse(phone_number)
+
+            fast = fast_normalize(phone_number)
+            if fast is not None:
+                # fast path never disagrees with phonenumbers, validity is left to the plan lookup
+                self.assertEqual(fast, e164, phone_number)
+                self.assertEqual(normalize(phone_number), fast, phone_number)
+            elif valid:
+                self.assertEqual(normalize(phone_number), e164, phone_number)
+            else:
+                self.assertRaises(ValueError, normalize, phone_number)
+
+    def test_fallbacks(self):
+        # +76/+77 codes belong to Kazakhstan, +8 is not a country code
+        for phone_number, expected in [('+77012345678', '77012345678'), ('87012345678', '77012345678'),
+                                       ('+76000000000', None), ('+89001234567', None)]:
+            self.assertIsNone(fast_normalize(phone_number), phone_number)
+            if expected:
+                self.assertEqual(normalize(phone_number), expected)
+            else:
+                self.assertRaises(ValueError, normalize, phone_number)
+
+
+class PlanRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves `server.content` at any path with a fixed ETag, honouring If-None-Match and If-Range/Range
+    """
+
+    def do_GET(self):
+        content, etag = self.server.content, self.server.etag
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        offset = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            offset = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (offset, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Sat, 17 Oct 2026 10:00:00 GMT')
+        self.send_header('Content-Length', str(len(content) - offset))
+        self.end_headers()
+        self.wfile.write(content[offset:])
+
+    def log_message(self, *args):
+        pass
+
+
+class PlanFetcherTestCase(TestCase):
+    """
+    `PlanFetcher` against a local HTTP stand-in of the rossvyaz site
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(PlanFetcherTestCase, cls).setUpClass()
+        cls.tmp_dir = tempfile.mkdtemp(prefix='rfnumplan-test-')
+        cls.plan_path = os.path.join(cls.tmp_dir, 'plan.csv')
+        write_plan_csv(cls.plan_path, 100, codes=range(900, 902))
+        with open(cls.plan_path, 'rb') as f:
+            content = f.read()
+
+        cls.server = HTTPServer(('127.0.0.1', 0), PlanRequestHandler)
+        cls.server.content, cls.server.etag = content, '"v1"'
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.tmp_dir)
+        super(PlanFetcherTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.cache_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        self.fetcher = PlanFetcher(cache_dir=self.cache_dir)
+        self.uri = 'http://127.0.0.1:%s/%s.csv' % (self.server.server_port, os.path.basename(self.cache_dir))
+        self.content_hash = hashlib.sha256(self.server.content).hexdigest()
+
+    def test_download(self):
+        fetched = self.fetcher.fetch(self.uri)
+        self.assertTrue(fetched.modified)
+        self.assertEqual(fetched.etag, '"v1"')
+        self.assertEqual(fetched.content_hash, self.content_hash)
+        with open(fetched.path, 'rb') as f:
+            self.assertEqual(f.read(), self.server.content)
+
+    def test_not_modified(self):
+        self.fetcher.fetch(self.uri)
+        fetched = self.fetcher.fetch(self.uri)
+        self.assertFalse(fetched.modified)
+        self.assertEqual(fetched.content_hash, self.content_hash)
+        self.assertEqual(self.server.requests[-1].get('If-None-Match'), '"v1"')
+
+    # generations are collected inline, a background thread can not share the in-memory test database
+    @mock.patch('rfnumplan.models.GC_IN_BACKGROUND', False)
+    def test_not_modified_skips_import(self):
+        NumberingPlan.objects.bulk_create([NumberingPlan(name='test', prefix=7, plan_uri=self.uri)])
+        plan = NumberingPlan.objects.get(name='test')
+        plan.fetch = lambda: self.fetcher.fetch(plan.plan_uri)
+
+        self.assertEqual(plan.do_import().created, 100)
+        stats = plan.do_import()
+        self.assertEqual(tuple(stats), (0, 0, 0, 0))
+        self.assertEqual(self.server.requests[-1].get('If-None-Match'), '"v1"')
+        self.assertEqual(NumberingPlanRange.objects.active().filter(numbering_plan=plan).count(), 100)
+
+    def test_resume(self):
+        _path, part_path, _meta_path = self.fetcher.get_paths(self.uri)
+        with open(part_path, 'wb') as f:
+            f.write(self.server.content[:1000])
+        self.fetcher.write_part_meta(self.uri, {'etag': '"v1"'})
+
+        fetched = self.fetcher.fetch(self.uri)
+        self.assertEqual(self.server.requests[-1].get('Range'), 'bytes=1000-')
+        self.assertEqual(fetched.content_hash, self.content_hash)
+        with open(fetched.path, 'rb') as f:
+            self.assertEqual(f.read(), self.server.content)
+        self.assertFalse(os.path.exists(part_path))
+
+    def test_file_uri(self):
+        fetched = self.fetcher.fetch(pathlib.Path(self.plan_path).as_uri())
+        self.assertEqual(fetched.path, self.plan_path)
+        self.assertEqual(fetched.content_hash, self.content_hash)
+        self.assertEqual(self.server.requests, [])
+
+
+class PlanTestCase(TestCase):
+    """
+    Base of tests over an imported synthetic plan
+    """
+
+    def setUp(self):
+        # generations are collected inline, a background thread can not share the in-memory test database
+        patcher = mock.patch('rfnumplan.models.GC_IN_BACKGROUND', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # process-wide name caches may hold instances of rolled back tests
+        operator_cache.clear()
+        region_cache.clear()
+
+    @staticmethod
+    def create_plan(name='test', **kwargs) -> NumberingPlan:
+        # bulk_create skips `NumberingPlan.save`, which would import the plan right away
+        NumberingPlan.objects.bulk_create([NumberingPlan(name=name, prefix=7, **kwargs)])
+        return NumberingPlan.objects.get(name=name)
+
+    @staticmethod
+    def plan_rows(count=300, seed=0) -> list:
+        return list(generate_plan_rows(count, operators=5, regions=5, codes=range(900, 903), seed=seed))
+
+
+class ImportGenerationsTestCase(PlanTestCase):
+    def test_full_import_swaps_generations(self):
+        plan = self.create_plan()
+        self.assertEqual(plan.import_full(self.plan_rows()), ImportStats(300, 0, 0, 0))
+        first_ids = set(plan.ranges.values_list('pk', flat=True))
+        self.assertEqual(set(plan.ranges.active().values_list('pk', flat=True)), first_ids)
+
+        # leftover of an interrupted import in the generation the next import is going to fill
+        leftover = plan.ranges.first()
+        leftover.pk, leftover.generation = None, plan.active_generation + 1
+        NumberingPlanRange.objects.bulk_create([leftover])
+
+        active_counts = set()
+
+        def bundles():
+            for bundle in self.plan_rows(200, seed=1):
+                active_counts.add(NumberingPlanRange.objects.active().filter(numbering_plan=plan).count())
+                yield bundle
+
+        self.assertEqual(plan.import_full(bundles()), ImportStats(200, 0, 300, 0))
+        # lookups saw the whole old plan until the switch
+        self.assertEqual(active_counts, {300})
+
+        plan.refresh_from_db()
+        self.assertEqual(plan.active_generation, 2)
+        self.assertEqual(plan.ranges.active().count(), 200)
+        # old generation and the leftover are collected
+        self.assertEqual(plan.ranges.count(), 200)
+        self.assertFalse(plan.ranges.filter(pk__in=first_ids).exists())
+        self.assertEqual(sum(plan.stats.values_list('range_count', flat=True)), 200)
+
+    def test_saved_range_joins_active_generation(self):
+        plan = self.create_plan()
+        plan.import_full(self.plan_rows())
+        plan.import_full(self.plan_rows())
+        self.assertEqual(plan.active_generation, 2)
+
+        nr = NumberingPlanRange(numbering_plan=plan, prefix=905, range_start=10000000, range_end=10000099,
+                                range_capacity=100, operator=Operator.objects.first(), region=Region.objects.first())
+        nr.save()
+        self.assertEqual(nr.generation, plan.active_generation)
+        self.assertEqual(nr.number_range, (79050000000, 79050000099))
+        self.assertEqual(list(NumberingPlanRange.find('+79050000050')), [nr])
+
+
+class IncrementalImportTestCase(PlanTestCase):
+    @staticmethod
+    def key(bundle: dict) -> tuple:
+        return int(bundle['prefix']), int('1' + bundle['range_start']), int('1' + bundle['range_end'])
+
+    def test_diff_counts(self):
+        plan = self.create_plan()
+        rows = self.plan_rows()
+        plan.import_full(rows)
+        ids = {(prefix, start, end): pk for pk, prefix, start, end
+               in plan.ranges.values_list('pk', 'prefix', 'range_start', 'range_end')}
+
+        updated = dict(rows[0], operator='ООО "Новый оператор"')
+        deleted = rows[1]
+        created = dict(rows[2], prefix='905')
+        changed = [updated, *rows[2:], created]
+        self.assertEqual(plan.import_incremental(changed), ImportStats(created=1, updated=1, deleted=1, unchanged=298))
+
+        stored = {(prefix, start, end): (pk, operator) for pk, prefix, start, end, operator
+                  in plan.ranges.active().values_list('pk', 'prefix', 'range_start', 'range_end', 'operator__name')}
+        self.assertEqual(len(stored), 300)
+        self.assertNotIn(self.key(deleted), stored)
+        self.assertEqual(stored[self.key(updated)], (ids[self.key(updated)], updated['operator']))
+        self.assertNotIn(self.key(created), ids)
+        for bundle in rows[2:]:
+            self.assertEqual(stored[self.key(bundle)][0], ids[self.key(bundle)], bundle)
+        self.assertEqual(sum(plan.stats.values_list('range_count', flat=True)), 300)
+
+        self.assertEqual(plan.import_incremental(changed), ImportStats(0, 0, 0, 300))
+
+
+class KeysetPaginationTestCase(PlanTestCase):
+    size = 7
+
+    def setUp(self):
+        super(KeysetPaginationTestCase, self).setUp()
+        plan = self.create_plan()
+        plan.import_full(self.plan_rows(100))
+        # duplicate keys are told apart by pk only
+        duplicates = list(plan.ranges.order_by('?')[:10])
+        for nr in duplicates:
+            nr.pk = None
+        NumberingPlanRange.objects.bulk_create(duplicates)
+
+        self.plan = plan
+        self.ranges = NumberingPlanRange.objects.all()
+        self.ordered = list(self.ranges.order_by(*RANGE_KEYS))
+        self.num_pages = -(-len(self.ordered) // self.size)
+
+    def offset_page(self, number: int, start=0) -> list:
+        bottom = start + (number - 1) * self.size
+        return self.ordered[bottom:bottom + self.size]
+
+    def test_pages(self):
+        pages = list(keyset_pages(self.ranges, self.size))
+        self.assertEqual([nr for page in pages for nr in page], self.ordered)
+        self.assertEqual(len(pages), self.num_pages)
+        for number in (1, 2, self.num_pages // 2, self.num_pages, self.num_pages + 1):
+            self.assertEqual(keyset_page(self.ranges, number, self.size), self.offset_page(number), number)
+
+    def test_values_pages(self):
+        values = self.ranges.values('range_end', *RANGE_KEYS)
+        self.assertEqual([row['pk'] for page in keyset_pages(values, self.size) for row in page],
+                         [nr.pk for nr in self.ordered])
+
+    def test_after(self):
+        for k in (0, 50, len(self.ordered) - self.size - 1, len(self.ordered) - 1):
+            after = parse_key(format_key(row_key(self.ordered[k], RANGE_KEYS)))
+            self.assertEqual(list(self.ranges.filter(seek_filter(RANGE_KEYS, after)).order_by(*RANGE_KEYS)),
+                             self.ordered[k + 1:], k)
+            for number in (1, 2, 3):
+                self.assertEqual(keyset_page(self.ranges, number, self.size, after=after),
+                                 self.offset_page(number, start=k + 1), (k, number))
+        self.assertRaises(ValueError, parse_key, '1,2')
+        self.assertRaises(ValueError, parse_key, '1,a,2,3')
+
+    def test_command_cursor(self):
+        out = io.StringIO()
+        call_command('rfnumplan', plan=str(self.plan.pk), page=2, page_size=self.size, stdout=out)
+        after = re.search(r'--after ([\d,]+)', out.getvalue()).group(1)
+        active = list(self.ranges.active().order_by(*RANGE_KEYS))
+        self.assertEqual(parse_key(after), row_key(active[2 * self.size - 1], RANGE_KEYS))
+
+        out = io.StringIO()
+        call_command('rfnumplan', plan=str(self.plan.pk), after=after, page_size=self.size, stdout=out)
+        after = re.search(r'--after ([\d,]+)', out.getvalue()).group(1)
+        self.assertEqual(parse_key(after), row_key(active[3 * self.size - 1], RANGE_KEYS))
+
+        self.assertRaises(CommandError, call_command, 'rfnumplan', plan=str(self.plan.pk), after='1,2', stdout=out)
+
+
+class LookupTestCase(PlanTestCase):
+    """
+    Base of lookup tests: random numbers of the plan, around it and invalid ones, along with the ranges
+    `NumberingPlanRange.find` returns for them
+    """
+    # add ranges that overlap plan ranges
+    overlapping = True
+
+    def setUp(self):
+        super(LookupTestCase, self).setUp()
+        rnd = random.Random(0)
+        plan = self.create_plan()
+        plan.import_full(self.plan_rows())
+        if self.overlapping:
+            overlaps = []
+            for nr in rnd.sample(list(plan.ranges.order_by('pk')), 30):
+                range_start = rnd.randint(nr.range_start, nr.range_end)
+                range_end = min(range_start + rnd.randrange(2 * nr.range_capacity), 19999999)
+                overlaps.append(NumberingPlanRange(
+                    numbering_plan=plan, prefix=nr.prefix, range_start=range_start, range_end=range_end,
+                    range_capacity=range_end - range_start + 1,
+                    number_start=absolute_number(plan.prefix, nr.prefix, range_start),
+                    number_end=absolute_number(plan.prefix, nr.prefix, range_end),
+                    operator_id=nr.operator_id, region_id=nr.region_id, generation=plan.active_generation,
+                ))
+            NumberingPlanRange.objects.bulk_create(overlaps)
+
+        bounds = list(NumberingPlanRange.objects.values_list('number_start', 'number_end'))
+        numbers = [rnd.randint(*rnd.choice(bounds)) for _ in range(500)]
+        numbers += [rnd.randrange(79000000000, 79040000000) for _ in range(500)]
+        self.numbers = ['+%s' % n for n in numbers] + ['abc', '+7900', '']
+
+        # sorted ids of ranges found by `NumberingPlanRange.find`, None for invalid numbers
+        self.expected = {}
+        for phone_number in self.numbers:
+            try:
+                self.expected[phone_number] = sorted(nr.pk for nr in NumberingPlanRange.find(phone_number))
+            except ValueError:
+                self.expected[phone_number] = None
+
+
+class RangeIndexTestCase(LookupTestCase):
+    def test_overlaps(self):
+        self.assertTrue(any(ids and len(ids) > 1 for ids in self.expected.values()))
+        self.assertTrue(any(ids == [] for ids in self.expected.values()))
+
+    def test_find(self):
+        index = RangeIndex.build()
+        for phone_number, expected in self.expected.items():
+            if expected is None:
+                self.assertRaises(ValueError, index.find, phone_number)
+            else:
+                self.assertEqual(sorted(nr.pk for nr in index.find(phone_number)), expected, phone_number)
+
+    def assert_find_many(self, index):
+        # ranges only, a portability overlay configured in settings would answer ported numbers
+        with mock.patch('rfnumplan.index.get_overlay', return_value=None):
+            results = index.find_many(self.numbers)
+        self.assertEqual([r.number for r in results], self.numbers)
+        for r in results:
+            expected = self.expected[r.number]
+            if expected is None:
+                self.assertEqual((r.e164, r.status, r.ranges, r.source), (None, INVALID, [], None), r.number)
+                continue
+            self.assertEqual(r.status, FOUND if expected else NOT_FOUND, r.number)
+            self.assertEqual(sorted(nr.pk for nr in r.ranges), expected, r.number)
+            self.assertEqual(r.source, RANGES)
+            self.assertEqual(r.operator, r.ranges[0].operator.name if r.ranges else None)
+
+    def test_find_many(self):
+        # vectorized with numpy if it is installed
+        self.assert_find_many(RangeIndex.build())
+
+    def test_find_many_pure_python(self):
+        with mock.patch('rfnumplan.index.np', None):
+            self.assert_find_many(RangeIndex.build())
+
+
+class PrefixTrieTestCase(LookupTestCase):
+    # longest prefix match names a single range, so plans must not overlap
+    overlapping = False
+
+    def test_lookup(self):
+        trie = PrefixTrie.build()
+        names = {nr.pk: (nr.operator.name, nr.region.name) for nr in NumberingPlanRange.objects.select_related()}
+        for phone_number, expected in self.expected.items():
+            if expected is None:
+                continue
+            record = trie.lookup(phone_number)
+            if not expected:
+                self.assertIsNone(record, phone_number)
+                continue
+            self.assertEqual([record.range_id], expected, phone_number)
+            self.assertEqual((record.operator, record.region), names[record.range_id])
+            self.assertTrue(phone_number.lstrip('+').startswith(record.prefix))
+
+
+class SnapshotTestCase(LookupTestCase):
+    def setUp(self):
+        super(SnapshotTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp(prefix='rfnumplan-test-')
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.tmp_dir, 'ranges.snapshot')
+        index = RangeIndex.build()
+        self.assertEqual(write_snapshot(path, index), len(index))
+        snapshot = Snapshot(path)
+        self.assertEqual(len(snapshot), len(index))
+        self.assertEqual(snapshot.version, version_hash(index.version))
+
+        ranges = {nr.pk: nr for nr in NumberingPlanRange.objects.select_related()}
+        for phone_number, expected in self.expected.items():
+            if expected is None:
+                continue
+            records = snapshot.lookup(int(normalize(phone_number)))
+            self.assertEqual(sorted(record.range_id for record in records), expected, phone_number)
+            for record in records:
+                nr = ranges[record.range_id]
+                self.assertEqual((record.number_start, record.number_end, record.operator, record.region),
+                                 (nr.number_start, nr.number_end, nr.operator.name, nr.region.name))
+
+    def test_not_a_snapshot(self):
+        path = os.path.join(self.tmp_dir, 'plan.csv')
+        write_plan_csv(path, 10)
+        self.assertRaises(ValueError, Snapshot, path)
+
+
+class PortabilityOverlayTestCase(TestCase):
+    @staticmethod
+    def random_rows(rnd, count: int, operators='ABCD') -> list:
+        # numbers repeat and some rows return them to the range owner
+        return [(79000000000 + rnd.randrange(count), rnd.choice(operators + ' ').strip()) for _ in range(count)]
+
+    @staticmethod
+    def apply(ported: dict, rows) -> dict:
+        for number, operator in rows:
+            if operator:
+                ported[number] = operator
+            else:
+                ported.pop(number, None)
+        return ported
+
+    def assert_overlay(self, overlay, ported: dict):
+        self.assertEqual(len(overlay), len(ported))
+        numbers = sorted(set(ported) | {79000000000 - 1, 79999999999})
+        self.assertEqual(overlay.lookup_many(numbers), [ported.get(number) for number in numbers])
+        for number in numbers:
+            self.assertEqual(overlay.lookup(number), ported.get(number), number)
+
+    def test_build(self):
+        overlay = PortabilityOverlay.build([(79000000002, 'A'), (79000000001, 'B'), (79000000002, 'C'),
+                                            (79000000003, 'A'), (79000000003, '')])
+        self.assert_overlay(overlay, {79000000001: 'B', 79000000002: 'C'})
+
+    def test_delta(self):
+        rnd = random.Random(0)
+        rows, delta_rows = self.random_rows(rnd, 2000), self.random_rows(rnd, 500, operators='CDE')
+        base = PortabilityOverlay.build(rows)
+        overlay = PortabilityOverlay.build(delta_rows, base=base)
+        self.assert_overlay(overlay, self.apply(self.apply({}, rows), delta_rows))
+        # operators of the base keep their codes
+        self.assertEqual(overlay.operator_names()[:len(base.operators)], base.operator_names())
+
+    def test_compact_paths(self):
+        rnd = random.Random(1)
+        numbers, codes = array('q'), array('H')
+        for number, operator in self.random_rows(rnd, 2000):
+            numbers.append(number)
+            codes.append(ord(operator) if operator else REMOVED)
+
+        with_numpy = PortabilityOverlay.compact(numbers, codes)
+        with mock.patch('rfnumplan.portability.np', None):
+            pure_python = PortabilityOverlay.compact(numbers, codes)
+        self.assertEqual(with_numpy, pure_python)
+
+        expected = self.apply({}, ((n, chr(c) if c != REMOVED else '') for n, c in zip(numbers, codes)))
+        self.assertEqual(list(pure_python[0]), sorted(expected))
+        self.assertEqual([chr(c) for c in pure_python[1]], [expected[n] for n in sorted(expected)])
+
+    def test_save_load(self):
+        tmp_dir = tempfile.mkdtemp(prefix='rfnumplan-test-')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'ported.bin')
+
+        rnd = random.Random(2)
+        rows = self.random_rows(rnd, 2001)
+        PortabilityOverlay.build(rows).save(path)
+        loaded = PortabilityOverlay.load(path)
+        self.assert_overlay(loaded, self.apply({}, rows))
+        self.assertEqual(loaded.path, path)
+
+        delta_rows = self.random_rows(rnd, 300, operators='EF')
+        PortabilityOverlay.build(delta_rows, base=loaded).save(path)
+        self.assert_overlay(PortabilityOverlay.load(path), self.apply(self.apply({}, rows), delta_rows))
+
+        write_plan_csv(path, 10)
+        self.assertRaises(ValueError, PortabilityOverlay.load, path)
@@ -0,0 +1,96 @@
+from array import array
+from collections import namedtuple
+
+from rfnumplan.index import VersionedInstance
+from rfnumplan.utils import range_to_prefix
+
+
+PrefixRecord = namedtuple('PrefixRecord', ['prefix', 'range_id', 'operator', 'region'])
+
+
+class PrefixTrie(object):
+    """
+    Digit trie compiled into flat arrays: children of node `n` are `children[n * 10 + digit]` (0 means no child),
+    `values[n]` is the index of the record stored at `n` or -1.
+    Built from exact prefix covers of all active ranges, so the longest matching prefix of a number
+    identifies its range in O(number length) without phonenumbers or the database.
+    """
+
+    def __init__(self, version=None, operators: dict = None, regions: dict = None):
+        self.version = version
+        self.operators = operators or {}
+        self.regions = regions or {}
+
+        self.children = array('i', [0] * 10)
+        self.values = array('i', [-1])
+        self.range_ids, self.operator_ids, self.region_ids = array('q'), array('i'), array('i')
+
+    def __len__(self):
+        return len(self.range_ids)
+
+    @classmethod
+    def build(cls, version=None):
+        from rfnumplan.models import NumberingPlanRange, Operator, Region
+
+        trie = cls(version=version,
+                   operators=dict(Operator.objects.values_list('pk', 'name')),
+                   regions=dict(Region.objects.values_list('pk', 'name')))
+
+        fields = ['number_start', 'number_end', 'pk', 'operator_id', 'region_id']
+        ranges = NumberingPlanRange.objects.active().order_by('number_start').values_list(*fields)
+        for start, end, pk, operator_id, region_id in ranges.iterator():
+            for prefix in range_to_prefix(start, end):
+                trie.insert(str(prefix), pk, operator_id, region_id)
+        return trie
+
+    def insert(self, prefix: str, range_id: int, operator_id: int, region_id: int):
+        children, node = self.children, 0
+        for digit in prefix:
+            slot = node * 10 + ord(digit) - 48
+            if not children[slot]:
+                children[slot] = len(self.values)
+                children.extend([0] * 10)
+                self.values.append(-1)
+            node = children[slot]
+
+        self.values[node] = len(self.range_ids)
+        self.range_ids.append(range_id)
+        self.operator_ids.append(operator_id)
+        self.region_ids.append(region_id)
+
+    def lookup(self, number: str):
+        """
+        :param number: E.164 digits, leading `+` is allowed
+        :return: `PrefixRecord` of the longest matching prefix or None
+        """
+        number = number.lstrip('+')
+        children, values = self.children, self.values
+        node, found, depth = 0, -1, 0
+        for i, digit in enumerate(number):
+            code = ord(digit) - 48
+            if not 0 <= code <= 9:
+                break
+            node = children[node * 10 + code]
+            if not node:
+                break
+            if values[node] >= 0:
+                found, depth = values[node], i + 1
+
+        if found < 0:
+            return None
+        return PrefixRecord(
+            prefix=number[:depth],
+            range_id=self.range_ids[found],
+            operator=self.operators.get(self.operator_ids[found]),
+            region=self.regions.get(self.region_ids[found]),
+        )
+
+
+_trie = VersionedInstance(PrefixTrie.build)
+
+
+def get_trie(check_version=True) -> PrefixTrie:
+    """
+    Returns process-wide `PrefixTrie`, rebuilt when stored plans version changes
+    """
+    return _trie.get(check_version=check_version)
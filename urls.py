@@ -0,0 +1,8 @@
+from django.conf.urls import url
+
+from . import views
+
+urlpatterns = [
+    url(r'^lookup/$', views.lookup, name='rfnumplan-lookup'),
+    url(r'^lookup/(?P<number>[^/]+)/$', views.lookup, name='rfnumplan-lookup-number'),
+]
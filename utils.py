@@ -1,4 +1,6 @@
 import csv
+from collections import Counter
+from itertools import islice
 
 
 FIELDS = [
@@ -11,48 +13,119 @@ FIELDS = [
 ]
 
 
+def iter_csv_num_plan(lines) -> iter:
+    """
+    Lazily parses rossvyaz csv lines (header included) into bundles with FIELDS keys
+    """
+    reader = csv.reader(lines, delimiter=';')
+    next(reader, None)
+    for row in reader:
+        if not row:
+            continue
+
+        yield dict(zip(FIELDS, (c.strip() for c in row)))
+
+
 def read_csv_num_plan(filepath: str) -> dict:
-    reader = csv.reader(open(filepath, 'r', encoding='cp1251'), delimiter=';')
     res = {
         'data': [],
         'operators': set(),
         'regions': set(),
     }
-    reader.__next__()
-    for row in reader:
-        if not row:
-            continue
-
-        row = [c.strip() for c in row]
-        bundle = dict(zip(FIELDS, row))
-        res['data'].append(bundle)
-        res['operators'].add(bundle['operator'])
-        res['regions'].add(bundle['region'])
+    with open(filepath, 'r', encoding='cp1251', newline='') as f:
+        for bundle in iter_csv_num_plan(f):
+            res['data'].append(bundle)
+            res['operators'].add(bundle['operator'])
+            res['regions'].add(bundle['region'])
 
     return res
 
 
+def chunked(iterable, size: int) -> iter:
+    """
+    Splits iterable into lists of at most `size` items without materializing it
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def map_instances_by_name(model_class, items_names: list) -> dict:
+    if not items_names:
+        return {}
     existent_item_names = model_class.objects.filter(name__in=items_names).values_list('name', flat=True)
     missing = set(items_names) - set(existent_item_names)
     model_class.objects.bulk_create(model_class(name=name) for name in missing)
     return {item.name: item for item in model_class.objects.filter(name__in=items_names)}
 
 
-def range_to_prefix(a, b):
-    def inner(aa, bb, p):
-        if p == 1:
-            if a <= aa <= b:
-                yield aa
-            return
+def absolute_number(plan_prefix, prefix, local_number) -> int:
+    """
+    Builds a full number from plan prefix, range prefix and `1`-prefixed local number:
+    absolute_number(7, 900, 15550000) -> 79005550000
+    """
+    return int('%s%s%s' % (plan_prefix, prefix, str(local_number)[1:]))
 
-        for d in range(aa, bb + 1, p):
-            if a <= d and d + p - 1 <= b:
-                yield d // p
-            elif not (bb < a or aa > b):
-                for i in range(10):
-                    yield from inner(d + i * p // 10, d + (i + 1) * p // 10 - 1, p // 10)
 
+def range_to_prefix(a, b):
+    """
+    Yields the minimal ascending set of decimal prefixes covering numbers [a; b]:
+    range_to_prefix(79005550000, 79005555549) -> 7900555, 790055550, ..., 79005555540
+    Every prefix has at least one digit: blocks never grow past 10 ** (digits of the longer bound - 1),
+    so range_to_prefix(100, 999) -> 1, 2, ..., 9 rather than an empty prefix.
+    """
     a, b = int(a), int(b)
-    p = 10**(max(len(str(x)) for x in (a, b)) - 1)
-    yield from inner(a // p * p, b // p * p + p - 1, p)
+    top = 10 ** (len(str(max(a, b))) - 1)
+    while a <= b:
+        p = 1
+        # widest aligned block starting at `a` that still fits into [a; b]
+        while p < top and a % (p * 10) == 0 and a + p * 10 - 1 <= b:
+            p *= 10
+        yield a // p
+        a += p
+
+
+def ranges_to_prefixes(pairs) -> list:
+    """
+    Bulk form of `range_to_prefix`
+    :param pairs: iterable of (start, end) pairs, e.g. zip(starts, ends) of two arrays
+    :return: list of prefix lists in the order of `pairs`
+    """
+    return [list(range_to_prefix(a, b)) for a, b in pairs]
+
+
+def coalesce_ranges(ranges) -> iter:
+    """
+    Merges contiguous or overlapping ranges that share the same key.
+    :param ranges: iterable of (key, start, end) sorted by (key, start)
+    :return: iterator of merged (key, start, end)
+    """
+    current = None
+    for key, start, end in ranges:
+        if current and current[0] == key and start <= current[2] + 1:
+            current[2] = max(current[2], end)
+            continue
+        if current:
+            yield tuple(current)
+        current = [key, start, end]
+    if current:
+        yield tuple(current)
+
+
+def collapse_prefixes(prefixes) -> list:
+    """
+    Replaces every complete set of ten sibling prefixes with their parent, repeatedly:
+    ['790', '791', ..., '799'] -> ['79']
+    :return: sorted list of prefixes
+    """
+    res = set(map(str, prefixes))
+    while True:
+        parents = [parent for parent, cnt in Counter(p[:-1] for p in res if len(p) > 1).items() if cnt == 10]
+        if not parents:
+            return sorted(res)
+        for parent in parents:
+            res.difference_update(parent + digit for digit in '0123456789')
+            res.add(parent)
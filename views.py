@@ -1,3 +1,91 @@
-from django.shortcuts import render
+import hashlib
+import json
 
-# Create your views here.
+from django.http import JsonResponse, HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from rfnumplan.index import get_index
+from rfnumplan.portability import get_overlay
+from rfnumplan.snapshot import version_hash
+
+from .settings import LOOKUP_MAX_BATCH, LOOKUP_MAX_AGE
+
+
+def serialize_range(nr) -> dict:
+    return {
+        'id': nr.pk,
+        'plan': nr.numbering_plan.name,
+        'plan_prefix': nr.numbering_plan.prefix,
+        'prefix': nr.prefix,
+        'range_start': str(nr.range_start)[1:],
+        'range_end': str(nr.range_end)[1:],
+        'range_capacity': nr.range_capacity,
+        'operator': nr.operator.name,
+        'region': nr.region.name,
+    }
+
+
+def serialize_result(result) -> dict:
+    return {
+        'number': result.number,
+        'e164': result.e164,
+        'status': result.status,
+        'source': result.source,
+        'operator': result.operator,
+        'ranges': [serialize_range(nr) for nr in result.ranges],
+    }
+
+
+def error(message: str, status: int) -> JsonResponse:
+    return JsonResponse({'error': message}, status=status)
+
+
+def parse_numbers(request):
+    """
+    :return: list of numbers from {"numbers": [...]} json body or error response
+    """
+    try:
+        numbers = json.loads(request.body.decode('utf-8'))['numbers']
+    except (ValueError, KeyError, TypeError):
+        return error('expected {"numbers": [...]} json body', 400)
+    if not isinstance(numbers, list) or not all(isinstance(n, str) for n in numbers):
+        return error('`numbers` must be a list of strings', 400)
+    if len(numbers) > LOOKUP_MAX_BATCH:
+        return error('at most %s numbers per request' % LOOKUP_MAX_BATCH, 413)
+    return numbers
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'HEAD', 'POST'])
+def lookup(request, number=None):
+    """
+    GET  /lookup/?number=79251234567 or /lookup/79251234567/ -> single result
+    POST /lookup/ {"numbers": [...]} -> {"results": [...]}, at most RFNUMPLAN_LOOKUP_MAX_BATCH numbers
+    Answers come from the per-process range index. GET responses carry an ETag derived from the plans
+    data version and the portability overlay file, so clients and proxies can revalidate them cheaply.
+    """
+    index = get_index()
+
+    if request.method == 'POST':
+        numbers = parse_numbers(request)
+        if isinstance(numbers, HttpResponse):
+            return numbers
+        return JsonResponse({'results': [serialize_result(r) for r in index.find_many(numbers)]})
+
+    number = number or request.GET.get('number')
+    if not number:
+        return error('`number` is required', 400)
+
+    overlay = get_overlay()
+    version = (index.version, overlay.file_id if overlay else None)
+    etag = '"%x-%s"' % (version_hash(version), hashlib.sha1(number.encode('utf-8')).hexdigest()[:16])
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponse(status=304)
+    else:
+        response = JsonResponse(serialize_result(index.find_many([number])[0]))
+
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=LOOKUP_MAX_AGE)
+    return response